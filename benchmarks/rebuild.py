@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Time builds of the sample site, and check that unchanged ones do nothing.
+
+Usage: python benchmarks/rebuild.py [doit_arguments ...]
+
+Copies Nikola's sample site to a temporary folder and builds it: from
+scratch, again without changes, after editing a post, and once more
+without changes. Prints how long each build took and how many tasks it
+ran. A build without changes must run no task besides render_site:all,
+which always runs.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Tasks that run in every build
+ALWAYS = ['render_site:all']
+
+
+def build(site, args):
+    """Build the site, return the names of the tasks that ran."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + filter(None, [env.get('PYTHONPATH')]))
+    doit = subprocess.Popen([sys.executable, '-c',
+        'import sys; from doit.doit_cmd import cmd_main; '
+        'sys.exit(cmd_main(sys.argv[1:]))'] + args,
+        cwd=site, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = doit.communicate()[0]
+    if doit.returncode:
+        print output
+        sys.exit('The build failed')
+    return [line[1:].strip() for line in output.splitlines()
+        if line.startswith('.  ')]
+
+
+def main():
+    args = sys.argv[1:]
+    folder = tempfile.mkdtemp()
+    try:
+        site = os.path.join(folder, 'site')
+        shutil.copytree(os.path.join(ROOT, 'nikola', 'data', 'samplesite'),
+            site)
+        post = os.path.join(site, 'posts', '1.txt')
+        failed = False
+        for label, change, must_be_noop in [
+                ('First build', None, False),
+                ('No changes', None, True),
+                ('Edited a post', post, False),
+                ('No changes', None, True)]:
+            if change:
+                with open(change, 'ab') as source:
+                    source.write('\nOne more line.\n')
+            start = time.time()
+            ran = build(site, args)
+            seconds = time.time() - start
+            print '%-16s %7.2f s %5d tasks' % (label, seconds, len(ran))
+            extra = [name for name in ran if name not in ALWAYS]
+            if must_be_noop and extra:
+                print '    ran without changes: %s' % ', '.join(extra)
+                failed = True
+        if failed:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Compare memory used by sitemap_gen's duplicate URL tracking.
+
+Usage: python benchmarks/sitemap_dedup.py [number_of_urls ...]
+
+For each number of URLs (by default 1000000 and 10000000), records
+every URL hash twice, as Sitemap.ConsumeURL does, in a dictionary (the
+old Sitemap._urls) and in a sitemap_gen.URLCounter. Each run happens in
+its own process, and the growth of its peak resident memory is printed.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nikola'))
+
+import sitemap_gen
+
+
+def fill(urls, count):
+    for i in xrange(count):
+        hash = hashlib.md5('http://example.com/posts/%d.html' % i).digest()
+        if hash in urls:
+            urls[hash] = urls[hash] + 1
+        else:
+            urls[hash] = 1
+    # See every URL again, as duplicates
+    for i in xrange(count):
+        hash = hashlib.md5('http://example.com/posts/%d.html' % i).digest()
+        urls[hash] = urls[hash] + 1
+
+
+def measure(kind, count, results):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if kind == 'dict':
+        urls = {}
+    else:
+        urls = sitemap_gen.URLCounter()
+    fill(urls, count)
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    results.put((after - before, seconds))
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000000, 10000000]
+    for count in counts:
+        for kind in ('dict', 'URLCounter'):
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure,
+                args=(kind, count, results))
+            process.start()
+            kib, seconds = results.get()
+            process.join()
+            print '%10d URLs %-12s %8.1f MiB %6.1f bytes/URL %7.1f sec' % (
+                count, kind, kib / 1024.0, kib * 1024.0 / count, seconds)
+
+
+if __name__ == '__main__':
+    main()
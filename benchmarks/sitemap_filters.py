@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Compare sitemap_gen's filter loop with the compiled FilterSet.
+
+Usage: python benchmarks/sitemap_filters.py [number_of_urls] [number_of_filters]
+
+Makes a list of wildcard and regexp filters, half of them "pass" and half
+"drop", and prints URLs/second for trying each Filter in turn (as
+Sitemap.ConsumeURL used to) and for a FilterSet. Both must give the same
+result for every URL.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nikola'))
+
+import sitemap_gen
+
+SECTIONS = ['posts', 'stories', 'categories', 'galleries', 'assets', 'files',
+    'archive', 'drafts', 'private', 'tmp']
+
+
+def make_filters(count):
+    filters = []
+    for i in range(count):
+        section = SECTIONS[i % len(SECTIONS)]
+        action = ('drop', 'pass')[i % 2]
+        if i % 3:
+            attributes = {'type': 'wildcard', 'action': action,
+                'pattern': 'http://example.com/%s/%d*.html' % (section, i)}
+        else:
+            attributes = {'type': 'regexp', 'action': action,
+                'pattern': r'/%s/\d*%d[^/]*\.(jpg|png)$' % (section, i)}
+        filters.append(sitemap_gen.Filter(attributes))
+    return filters
+
+
+def make_urls(count):
+    random.seed(0)
+    urls = []
+    for i in xrange(count):
+        url = sitemap_gen.URL()
+        url.loc = 'http://example.com/%s/%d.%s' % (random.choice(SECTIONS),
+            random.randint(0, 100000), random.choice(['html', 'jpg', 'png']))
+        urls.append(url)
+    return urls
+
+
+def apply_loop(filters, url):
+    accept = None
+    for filter in filters:
+        accept = filter.Apply(url)
+        if accept != None:
+            break
+    return accept
+
+
+def main():
+    url_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    filter_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    sitemap_gen.output.SetVerbose(0)
+    filters = make_filters(filter_count)
+    urls = make_urls(url_count)
+    print '%d URLs, %d filters' % (url_count, filter_count)
+
+    start = time.time()
+    expected = [apply_loop(filters, url) for url in urls]
+    seconds = time.time() - start
+    print '%-24s %10.0f URLs/sec' % ('Filter loop', url_count / seconds)
+
+    start = time.time()
+    filter_set = sitemap_gen.FilterSet(filters)
+    results = [filter_set.Apply(url) for url in urls]
+    seconds = time.time() - start
+    print '%-24s %10.0f URLs/sec' % ('FilterSet', url_count / seconds)
+
+    if results != expected:
+        print 'FilterSet results differ from the loop!'
+        sys.exit(1)
+    print 'Decisions: %d pass, %d drop, %d undecided' % (
+        expected.count(True), expected.count(False), expected.count(None))
+
+
+if __name__ == '__main__':
+    main()
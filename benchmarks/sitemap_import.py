@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Compare sitemap_gen's InputSitemap and InputSitemapStream.
+
+Usage: python benchmarks/sitemap_import.py [number_of_urls]
+
+Writes a Sitemap index pointing to gzipped Sitemap files with the given
+number of URLs in total (by default 500000), and prints URLs/second and
+the growth of peak memory while reading them with each input. Each input
+runs in its own process. Both must give the same URLs in the same
+order, written the same way to a Sitemap.
+"""
+
+import cStringIO
+import gzip
+import hashlib
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nikola'))
+
+import sitemap_gen
+
+URLS_PER_FILE = 50000
+
+
+def write_sitemaps(folder, count):
+    index = open(os.path.join(folder, 'sitemap_index.xml'), 'w')
+    index.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    for number, start in enumerate(xrange(0, count, URLS_PER_FILE)):
+        name = 'sitemap%d.xml.gz' % number
+        out = gzip.open(os.path.join(folder, name), 'wb')
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for i in xrange(start, min(start + URLS_PER_FILE, count)):
+            out.write(' <url>\n  <loc>http://example.com/posts/%d.html</loc>\n'
+                '  <lastmod>2012-01-%02d</lastmod>\n'
+                '  <changefreq>weekly</changefreq>\n'
+                '  <priority>0.5</priority>\n </url>\n' % (i, i % 28 + 1))
+        out.write('</urlset>\n')
+        out.close()
+        index.write(' <sitemap><loc>http://example.com/%s</loc></sitemap>\n'
+            % name)
+    index.write('</sitemapindex>\n')
+    index.close()
+    return os.path.join(folder, 'sitemap_index.xml')
+
+
+def measure(input_class, path, results):
+    sitemap_gen.output.SetVerbose(0)
+    counted = [0]
+    # A digest of the URLs as written to a Sitemap rather than a list,
+    # which would use memory
+    digest = hashlib.md5()
+
+    def consumer(url, allow_fragment):
+        counted[0] += 1
+        xml = cStringIO.StringIO()
+        url.WriteXML(xml)
+        digest.update(xml.getvalue())
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    input_class({'path': path}).ProduceURLs(consumer)
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((counted[0], seconds, after - before, digest.hexdigest()))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    folder = tempfile.mkdtemp()
+    try:
+        print 'Writing %d URLs...' % count
+        path = write_sitemaps(folder, count)
+        digests = set()
+        for input_class in (sitemap_gen.InputSitemap,
+                sitemap_gen.InputSitemapStream):
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure,
+                args=(input_class, path, results))
+            process.start()
+            # The results are small enough to wait for the process first
+            process.join()
+            if process.exitcode:
+                sys.exit('%s failed' % input_class.__name__)
+            urls, seconds, kib, digest = results.get()
+            digests.add(digest)
+            print '%-20s %8d URLs %10.0f URLs/sec %8.1f MiB' % (
+                input_class.__name__, urls, urls / seconds, kib / 1024.0)
+    finally:
+        shutil.rmtree(folder)
+    if len(digests) != 1:
+        print 'InputSitemapStream URLs differ from InputSitemap!'
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
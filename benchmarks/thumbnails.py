@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Compare thumbnailing speed of the old create_thumb and galleries.
+
+Usage: python benchmarks/thumbnails.py [number_of_images] [width] [height]
+
+Generates JPEG files in a temporary folder and prints images/second for
+the old full-decode thumbnailer and for galleries.create_derivatives.
+create_images on its own shows the decoding and scaling alone, without
+hashing sources for the cache.
+
+Then the same for a thumbnail and scaled copies at WIDTHS, comparing
+create_images (each copy scaled from the previous, larger one) with
+scaling every copy from the decoded image.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nikola'))
+
+import galleries
+
+THUMBNAIL_SIZE = 180
+WIDTHS = (480, 960, 1920)
+
+
+def old_create_thumb(src, dst):
+    """create_thumb as it was in gen_task_render_galleries."""
+    Image = galleries.get_image_module()
+    size = THUMBNAIL_SIZE, THUMBNAIL_SIZE
+    im = Image.open(src)
+    im.thumbnail(size, Image.ANTIALIAS)
+    im.save(dst)
+
+
+def separate_resizes(src, outputs):
+    """create_images, but scaling each derivative from the decoded image."""
+    Image = galleries.get_image_module()
+    im = Image.open(src)
+    sizes = [(galleries.fit(im.size, box), dst) for dst, box in outputs]
+    sizes.sort(reverse=True)
+    if im.format == 'JPEG':
+        im.draft(im.mode, sizes[0][0])
+    for size, dst in sizes:
+        im.resize(size, Image.ANTIALIAS).save(dst)
+
+
+def make_images(folder, count, width, height):
+    Image = galleries.get_image_module()
+    im = Image.new('RGB', (width, height))
+    # Something that is not trivial to compress
+    im.putdata([((x * 7) % 256, (x * 13) % 256, (x * 29) % 256)
+        for x in xrange(width * height)])
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, 'image%05d.jpg' % i)
+        # Every image must be different, or the cache makes one for all
+        im.putpixel((i % width, i // width % height), (255, 255, 255))
+        im.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def report(name, count, seconds):
+    print '%-36s %8.1f images/sec' % (name, count / seconds)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    height = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    if galleries.get_image_module() is None:
+        print 'PIL is not installed.'
+        return
+    folder = tempfile.mkdtemp()
+    try:
+        print 'Creating %d images of %dx%d...' % (count, width, height)
+        paths = make_images(folder, count, width, height)
+
+        start = time.time()
+        for path in paths:
+            old_create_thumb(path, path + '.old.thumbnail.jpg')
+        report('old create_thumb', count, time.time() - start)
+
+        start = time.time()
+        for path in paths:
+            galleries.create_images(path, [(path + '.new.thumbnail.jpg',
+                (THUMBNAIL_SIZE, THUMBNAIL_SIZE))])
+        report('create_images', count, time.time() - start)
+
+        for processes in (1, None):
+            jobs = [(path, [(path + '.%s.thumbnail.jpg' % processes,
+                (THUMBNAIL_SIZE, THUMBNAIL_SIZE))]) for path in paths]
+            cache_folder = os.path.join(folder, 'cache-%s' % processes)
+            start = time.time()
+            galleries.create_derivatives(jobs, cache_folder, processes)
+            report('create_derivatives (processes=%s)' % processes, count,
+                time.time() - start)
+
+        start = time.time()
+        galleries.create_derivatives(jobs, cache_folder, processes)
+        report('create_derivatives (warm cache)', count, time.time() - start)
+
+        print 'With scaled copies at widths %s:' % (WIDTHS,)
+        for name, function in [('create_images', galleries.create_images),
+                ('separate resizes', separate_resizes)]:
+            start = time.time()
+            for path in paths:
+                function(path, [(path + '.thumbnail.jpg',
+                    (THUMBNAIL_SIZE, THUMBNAIL_SIZE))] +
+                    [(path + '.w%d.jpg' % width, (width, None))
+                    for width in WIDTHS])
+            report(name, count, time.time() - start)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Asset bundles.
+
+A bundle is a list of CSS or JS files that are joined, minified and
+written with a name that includes a digest of their contents, like
+"assets/css/all.1a2b3c4d5e.css". Since the name changes whenever the
+contents do, bundles can be served with far-future cache headers.
+
+A manifest maps the logical name of each bundle ("assets/css/all.css")
+to the file actually written.
+"""
+
+import codecs
+import hashlib
+import json
+import os
+import re
+
+__all__ = ['minify_css', 'minify_js', 'hashed_name', 'sources_digest',
+    'build_bundle', 'write_manifest']
+
+# Strings and comments, which the CSS minifier must not look inside
+_CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/)',
+    re.DOTALL)
+_CSS_SPACES = re.compile(r'\s+')
+_CSS_PUNCTUATION = re.compile(r' ?([{};,>]) ?')
+# A space before ":" matters ("a :hover" is not "a:hover"), after it doesn't
+_CSS_COLON = re.compile(r': ')
+
+
+def minify_css(text):
+    """Remove comments and unneeded whitespace from CSS.
+
+    Comments starting with "/*!" (usually licenses) are kept.
+    """
+    parts = []
+    for i, part in enumerate(_CSS_TOKENS.split(text)):
+        if i % 2:
+            if part.startswith('/*') and not part.startswith('/*!'):
+                continue
+            parts.append(part)
+        else:
+            part = _CSS_SPACES.sub(' ', part)
+            part = _CSS_PUNCTUATION.sub(r'\1', part)
+            part = _CSS_COLON.sub(':', part)
+            parts.append(part.replace(';}', '}'))
+    return ''.join(parts).strip()
+
+
+def minify_js(text):
+    """Remove trailing whitespace and blank lines from JavaScript.
+
+    This is all that can be done safely without parsing it, so bundles
+    should list already minified files (like jquery.min.js) when they
+    exist.
+    """
+    lines = [line.rstrip() for line in text.splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+
+def hashed_name(name, digest):
+    """Return name with the first 10 characters of digest added.
+
+    "assets/css/all.css" becomes "assets/css/all.1a2b3c4d5e.css".
+    """
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, digest[:10], ext)
+
+
+def sources_digest(sources):
+    """Return the MD5 hex digest of a list of files' names and contents."""
+    digest = hashlib.md5()
+    for src in sources:
+        digest.update(src.encode('utf8') + '\0')
+        with open(src, 'rb') as in_file:
+            digest.update(in_file.read())
+    return digest.hexdigest()
+
+
+def build_bundle(sources, output_path):
+    """Join and minify sources into output_path.
+
+    The minifier is chosen by output_path's extension.
+    """
+    minify = {'.css': minify_css, '.js': minify_js}.get(
+        os.path.splitext(output_path)[1], lambda text: text)
+    texts = []
+    for src in sources:
+        with codecs.open(src, 'rb', 'utf8') as in_file:
+            texts.append(minify(in_file.read()))
+    # Keep JS statements from different files apart.
+    separator = u';\n' if output_path.endswith('.js') else u'\n'
+    dst_dir = os.path.dirname(output_path)
+    if dst_dir and not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    with codecs.open(output_path, 'wb+', 'utf8') as out_file:
+        out_file.write(separator.join(texts) + u'\n')
+
+
+def write_manifest(manifest, output_path):
+    """Write the manifest (logical name to hashed name) as JSON."""
+    dst_dir = os.path.dirname(output_path)
+    if dst_dir and not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    with open(output_path, 'wb') as out_file:
+        json.dump(manifest, out_file, indent=2, sort_keys=True)
@@ -0,0 +1,272 @@
+"""Remove CSS rules that no page uses.
+
+The element names, classes and ids used by each rendered page are
+collected with HTMLParser and kept in a cache keyed by path, mtime and
+size, so only pages that changed are parsed again.
+
+A selector is kept if every element, class and id it mentions is used
+somewhere (or matches the allowlist, for things added by JavaScript).
+Attribute selectors and pseudo-classes are ignored, so it errs on the
+side of keeping rules. At-rules other than @media, @supports and
+@document are always kept.
+"""
+
+import codecs
+import fnmatch
+from HTMLParser import HTMLParser, HTMLParseError
+import json
+import os
+import re
+
+__all__ = ['UsageCache', 'prune_css', 'prune_stylesheets']
+
+_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/)',
+    re.DOTALL)
+_STRUCTURE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|[{};]')
+_SELECTOR_SEPARATOR = re.compile(r',(?![^(\[]*[)\]])')
+_ATTRIBUTE = re.compile(r'\[[^\]]*\]')
+_PSEUDO = re.compile(r'::?[-\w]+(?:\([^)]*\))?')
+_CLASS = re.compile(r'\.(-?[_a-zA-Z][-\w]*)')
+_ID = re.compile(r'#(-?[_a-zA-Z][-\w]*)')
+_ELEMENT = re.compile(r'(?:^|[\s>+~])([a-zA-Z][-\w]*)')
+_NESTED = ('@media', '@supports', '@document')
+
+
+class _UsageParser(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.elements = set()
+        self.classes = set()
+        self.ids = set()
+
+    def handle_starttag(self, tag, attrs):
+        self.elements.add(tag.lower())
+        for name, value in attrs:
+            if not value:
+                continue
+            if name == 'class':
+                self.classes.update(value.split())
+            elif name == 'id':
+                self.ids.add(value)
+
+    handle_startendtag = handle_starttag
+
+
+def page_usage(path):
+    """Return (elements, classes, ids) used in an HTML file."""
+    parser = _UsageParser()
+    with codecs.open(path, 'rb', 'utf8', 'replace') as in_file:
+        try:
+            parser.feed(in_file.read())
+            parser.close()
+        except HTMLParseError:
+            # Keep what was found before the error
+            pass
+    return (sorted(parser.elements), sorted(parser.classes),
+        sorted(parser.ids))
+
+
+class UsageCache(object):
+    """Elements, classes and ids per page, stored in cache_folder."""
+
+    def __init__(self, cache_folder):
+        self.path = os.path.join(cache_folder, 'css_usage.json')
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as cache_file:
+                try:
+                    self.entries = json.load(cache_file)
+                except ValueError:
+                    # Unreadable, so pages are just parsed again
+                    pass
+
+    def usage(self, pages):
+        """Return the sets of elements, classes and ids used in pages.
+
+        Pages not in the list are forgotten.
+        """
+        entries = {}
+        for page in pages:
+            stat = os.stat(page)
+            entry = self.entries.get(page)
+            if not entry or entry[:2] != [stat.st_mtime, stat.st_size]:
+                entry = [stat.st_mtime, stat.st_size] + list(page_usage(page))
+            entries[page] = entry
+        self.entries = entries
+        elements, classes, ids = set(), set(), set()
+        for entry in entries.values():
+            elements.update(entry[2])
+            classes.update(entry[3])
+            ids.update(entry[4])
+        return elements, classes, ids
+
+    def save(self):
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Never leave a truncated file behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            json.dump(self.entries, cache_file)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+
+
+def _block_end(css, pos):
+    """Return the position of the "}" closing the block open at pos."""
+    depth = 1
+    while depth:
+        match = _STRUCTURE.search(css, pos)
+        if match is None:
+            return len(css)
+        pos = match.end()
+        if match.group() == '{':
+            depth += 1
+        elif match.group() == '}':
+            depth -= 1
+    return pos - 1
+
+
+def parse_rules(css, pos=0):
+    """Split CSS (without comments) into rules.
+
+    Returns (rules, end) where each rule is (prelude, body). body is
+    None for statements (like @import), a list of rules for @media and
+    similar, and the text between the braces otherwise.
+    """
+    rules = []
+    start = pos
+    while True:
+        match = _STRUCTURE.search(css, pos)
+        if match is None:
+            if css[start:].strip():
+                rules.append((css[start:].strip(), None))
+            return rules, len(css)
+        token = match.group()
+        pos = match.end()
+        if token == ';':
+            rules.append((css[start:pos].strip(), None))
+            start = pos
+        elif token == '}':
+            if css[start:match.start()].strip():
+                rules.append((css[start:match.start()].strip(), None))
+            return rules, pos
+        elif token == '{':
+            prelude = css[start:match.start()].strip()
+            if prelude.lower().startswith(_NESTED):
+                body, pos = parse_rules(css, pos)
+            else:
+                end = _block_end(css, pos)
+                body = css[pos:end]
+                pos = end + 1
+            rules.append((prelude, body))
+            start = pos
+
+
+def _is_used(selector, used, allowed):
+    selector = _PSEUDO.sub('', _ATTRIBUTE.sub('', selector))
+    elements, classes, ids = used
+    for names, pattern in ((classes, _CLASS), (ids, _ID)):
+        for name in pattern.findall(selector):
+            if name not in names and not allowed(name):
+                return False
+    selector = _ID.sub('', _CLASS.sub('', selector))
+    for name in _ELEMENT.findall(selector):
+        if name.lower() not in elements and not allowed(name):
+            return False
+    return True
+
+
+def _prune_rules(rules, used, allowed):
+    kept = []
+    for prelude, body in rules:
+        if body is None or (prelude.startswith('@') and
+                not isinstance(body, list)):
+            kept.append((prelude, body))
+        elif isinstance(body, list):
+            body = _prune_rules(body, used, allowed)
+            if body:
+                kept.append((prelude, body))
+        else:
+            selectors = [s.strip() for s in _SELECTOR_SEPARATOR.split(prelude)
+                if _is_used(s.strip(), used, allowed)]
+            if selectors:
+                kept.append((','.join(selectors), body))
+    return kept
+
+
+def _format_rules(rules):
+    parts = []
+    for prelude, body in rules:
+        if body is None:
+            parts.append(prelude)
+        elif isinstance(body, list):
+            parts.append('%s{\n%s}' % (prelude, _format_rules(body)))
+        else:
+            parts.append('%s{%s}' % (prelude, body.strip()))
+    return ''.join(part + '\n' for part in parts)
+
+
+def prune_css(css, used, allowlist=()):
+    """Return css without the rules that don't apply to used.
+
+    used is (elements, classes, ids). allowlist is a list of names or
+    fnmatch patterns that are always considered used. Comments are
+    removed, except those starting with "/*!" (usually licenses).
+    """
+    licenses = []
+    parts = []
+    for i, part in enumerate(_TOKENS.split(css)):
+        if i % 2 and part.startswith('/*'):
+            if part.startswith('/*!'):
+                licenses.append(part + '\n')
+        else:
+            parts.append(part)
+
+    def allowed(name):
+        for pattern in allowlist:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    rules, _ = parse_rules(''.join(parts))
+    return ''.join(licenses) + _format_rules(
+        _prune_rules(rules, used, allowed))
+
+
+def prune_stylesheets(pages, stylesheets, allowlist, cache_folder):
+    """Write pruned copies of stylesheets, for the rules pages use.
+
+    stylesheets is a list of (source, destination). Destinations are
+    only written when their contents change. Prints the bytes saved in
+    each one.
+    """
+    cache = UsageCache(cache_folder)
+    used = cache.usage(pages)
+    cache.save()
+    for src, dst in stylesheets:
+        with codecs.open(src, 'rb', 'utf8') as in_file:
+            css = in_file.read()
+        pruned = prune_css(css, used, allowlist)
+        old = None
+        if os.path.isfile(dst):
+            with codecs.open(dst, 'rb', 'utf8') as in_file:
+                old = in_file.read()
+        if pruned != old:
+            dst_dir = os.path.dirname(dst)
+            if dst_dir and not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            # dst may be a hard link to (or a clone of) the theme's own
+            # file, see COPY_STRATEGY, so never write into it.
+            tmp_path = dst + '.tmp'
+            with codecs.open(tmp_path, 'wb+', 'utf8') as out_file:
+                out_file.write(pruned)
+            if os.path.exists(dst):
+                os.unlink(dst)
+            os.rename(tmp_path, dst)
+        before = len(css.encode('utf8'))
+        after = len(pruned.encode('utf8'))
+        print '%s: %d bytes, %d after pruning (%d saved)' % (
+            dst, before, after, before - after)
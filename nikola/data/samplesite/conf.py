@@ -36,6 +36,52 @@ post_pages = (
 # FILES_FOLDERS = {'files': '' }
 # Which means copy 'files' into 'output'
 
+# How files (from FILES_FOLDERS, theme assets, gallery images and post
+# sources) are put into the output folder:
+# 'copy' makes regular copies.
+# 'hardlink' makes hard links, which use no extra disk space, but editing
+# a file in the output edits the original too.
+# 'reflink' makes copy-on-write clones, on filesystems that support them
+# (like btrfs or XFS).
+# If a link can't be made, the file is copied.
+# COPY_STRATEGY = 'copy'
+
+# If True, the CSS and JS files listed in BUNDLES are joined and minified
+# into a single file each, and pages load that instead. Bundles get a name
+# that changes with their contents, like assets/css/all.1a2b3c4d5e.css, so
+# they can be cached forever; assets/manifest.json lists the names.
+# Files listed in a bundle should be in the same folder as the bundle,
+# so relative URLs inside them still work. Missing files are skipped.
+# USE_BUNDLES = False
+# BUNDLES = {
+#     'assets/css/all.css': [
+#         'assets/css/bootstrap.css',
+#         'assets/css/bootstrap-responsive.css',
+#         'assets/css/rst.css',
+#         'assets/css/code.css',
+#         'assets/css/custom.css',
+#     ],
+#     'assets/js/gallery.js': [
+#         'assets/js/jquery-1.7.2.min.js',
+#         'assets/js/jquery.colorbox-min.js',
+#     ],
+# }
+
+# If True, after the site is built, the stylesheets in PRUNE_CSS_FILES are
+# written without the rules that don't apply to any page, and the bytes
+# saved are reported. Classes and ids that are only added by JavaScript
+# have to be listed in PRUNE_CSS_ALLOWLIST (fnmatch patterns are allowed).
+# This doesn't apply to bundles (see USE_BUNDLES).
+# PRUNE_CSS = False
+# PRUNE_CSS_FILES = (
+#     'assets/css/bootstrap.css',
+#     'assets/css/bootstrap-responsive.css',
+# )
+# PRUNE_CSS_ALLOWLIST = (
+#     'active', 'collapse', 'fade', 'in', 'open',
+#     'dropdown*', 'modal*', 'popover*', 'tooltip*',
+# )
+
 # A mapping of languages to file-extensions that represent that language.
 # Feel free to add or delete extensions to any list, but don't add any new
 # compilers unless you write the interface for it yourself.
@@ -67,16 +113,30 @@ TRANSLATIONS = {
 # output / TRANSLATION[lang] / TAG_PATH / index.html (list of tags)
 # output / TRANSLATION[lang] / TAG_PATH / tag.html (list of posts for a tag)
 # output / TRANSLATION[lang] / TAG_PATH / tag.xml (RSS feed for a tag)
+# output / TRANSLATION[lang] / TAG_PATH / tag.atom (Atom feed for a tag)
 TAG_PATH = "categories"
 # Final location is output / TRANSLATION[lang] / INDEX_PATH / index-*.html
 INDEX_PATH = ""
+# How many posts are shown on each index page (default 10)
+# INDEX_DISPLAY_POST_COUNT = 10
+# If True, index-1.html has the oldest posts and numbered index pages
+# keep their contents when new posts are added, so only index.html and
+# the newest numbered page are rebuilt. (default False)
+# INDEXES_STATIC = False
 # Final locations for the archives are:
 # output / TRANSLATION[lang] / ARCHIVE_PATH / archive.html
 # output / TRANSLATION[lang] / ARCHIVE_PATH / YEAR / index.html
 ARCHIVE_PATH = ""
 # Final locations are:
 # output / TRANSLATION[lang] / RSS_PATH / rss.xml
+# output / TRANSLATION[lang] / RSS_PATH / atom.xml
 RSS_PATH = ""
+# How many posts are included in each feed (default 10)
+# FEED_LENGTH = 10
+# If True, feeds take their build date from their newest post instead of
+# the current time, so feeds whose posts didn't change stay byte-identical
+# (and keep their modification time) between builds. (default False)
+# DETERMINISTIC_FEEDS = False
 
 # A list of redirection tuples, [("foo/from.html", "/bar/to.html")].
 #
@@ -101,6 +161,26 @@ DEPLOY_COMMANDS = []
 
 OUTPUT_FOLDER = 'output'
 
+# Where to keep data that is expensive to compute (like thumbnails) between
+# builds. It's safe to delete it.
+# CACHE_FOLDER = 'cache'
+
+# Where the sitemap's lastmod for each page comes from:
+# 'date' is the post's date (for lists of posts, the newest one's).
+# 'content' is the last time the rendered page actually changed, which is
+# remembered in CACHE_FOLDER, so rebuilding the site doesn't make every
+# page look modified.
+# SITEMAP_LASTMOD = 'date'
+
+# If True, write a .gz copy (at maximum compression) next to every text
+# file in the output that is at least GZIP_MIN_SIZE bytes long, for servers
+# that can send precompressed files, like nginx with gzip_static.
+# Run "doit -n 4" (or your number of cores) to compress in parallel.
+# GZIP_FILES = False
+# GZIP_EXTENSIONS = ('.txt', '.htm', '.html', '.css', '.js', '.json', '.xml',
+#     '.atom', '.svg')
+# GZIP_MIN_SIZE = 1024
+
 ##############################################################################
 # Image Gallery Options
 ##############################################################################
@@ -109,6 +189,20 @@ OUTPUT_FOLDER = 'output'
 # Final location of galleries will be output / GALLERY_PATH / gallery_name
 GALLERY_PATH = "galleries"
 THUMBNAIL_SIZE = 180
+# Thumbnails are made in parallel, by this many processes.
+# The default (None) is one per CPU.
+# THUMBNAIL_PROCESSES = None
+# Scaled down copies of each image are made at these widths, and
+# used by the gallery page instead of the original when the screen is
+# small enough (they are never wider than the original).
+# GALLERY_IMAGE_WIDTHS = (480, 960, 1920)
+# Sort gallery images by the date they were taken (from their EXIF
+# data) instead of by name. Images without a date go last.
+# GALLERY_SORT_BY_DATE = False
+# Split galleries in pages of this many images (0 means a single page).
+# Each page depends only on its own images, so adding images at the end
+# of a big gallery renders only its last page again.
+# GALLERY_PAGE_SIZE = 0
 
 ##############################################################################
 # HTML fragments and diverse things that are used by the templates
@@ -0,0 +1,171 @@
+"""RSS 2.0 and Atom feed rendering.
+
+Each post is serialized to XML once per language and feed format, and
+kept in a FeedItemCache. Feeds (the main one and one per tag) are then
+written by concatenating the cached items between a header and a footer.
+
+In deterministic mode the build date comes from the newest item and
+items are sorted by date and name, so a feed whose posts didn't change
+comes out byte-identical, and is not rewritten at all.
+"""
+
+import codecs
+import datetime
+import filecmp
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+__all__ = ['FeedItemCache', 'render_rss', 'render_atom']
+
+_DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def rfc822_date(dt):
+    """Format a datetime the way RSS wants it, ignoring the locale."""
+    return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+        _DAYS[dt.weekday()], dt.day, _MONTHS[dt.month - 1],
+        dt.year, dt.hour, dt.minute, dt.second)
+
+
+def rfc3339_date(dt):
+    """Format a datetime the way Atom wants it."""
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class FeedItemCache(object):
+    """Serialized feed items, keyed by post, language and format.
+
+    A post's text is read only once per language, no matter in how
+    many feeds it appears.
+    """
+
+    def __init__(self):
+        self._texts = {}
+        self._items = {}
+
+    def text(self, post, lang):
+        key = (post.post_name, lang)
+        if key not in self._texts:
+            self._texts[key] = post.text(lang)
+        return self._texts[key]
+
+    def rss_item(self, post, lang):
+        key = (post.post_name, lang, 'rss')
+        if key not in self._items:
+            link = escape(post.permalink(lang))
+            self._items[key] = (u'<item>'
+                u'<title>%s</title>'
+                u'<link>%s</link>'
+                u'<description>%s</description>'
+                u'<guid>%s</guid>'
+                u'<pubDate>%s</pubDate>'
+                u'</item>') % (
+                    escape(post.title(lang)), link,
+                    escape(self.text(post, lang)), link,
+                    rfc822_date(post.date))
+        return self._items[key]
+
+    def atom_entry(self, post, lang):
+        key = (post.post_name, lang, 'atom')
+        if key not in self._items:
+            link = post.permalink(lang, absolute=True)
+            self._items[key] = (u'<entry>'
+                u'<title>%s</title>'
+                u'<link href=%s/>'
+                u'<id>%s</id>'
+                u'<updated>%s</updated>'
+                u'<content type="html">%s</content>'
+                u'</entry>') % (
+                    escape(post.title(lang)), quoteattr(link),
+                    escape(link), rfc3339_date(post.date),
+                    escape(self.text(post, lang)))
+        return self._items[key]
+
+
+def _sorted_posts(posts, deterministic):
+    if deterministic:
+        return sorted(posts, key=lambda post: (post.date, post.post_name),
+            reverse=True)
+    return posts
+
+
+def _build_date(posts, deterministic, now):
+    if not deterministic:
+        return now()
+    if posts:
+        return max(post.date for post in posts)
+    return datetime.datetime(1970, 1, 1)
+
+
+def _open_feed(output_path):
+    dst_dir = os.path.dirname(output_path)
+    if dst_dir and not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    return codecs.open(output_path, "wb+", "utf8")
+
+
+def _replace_if_changed(tmp_path, output_path):
+    """Move tmp_path to output_path, unless the contents are the same.
+
+    That way an unchanged feed keeps its old modification time too.
+    """
+    if os.path.isfile(output_path) and filecmp.cmp(tmp_path, output_path,
+            shallow=False):
+        os.unlink(tmp_path)
+    else:
+        if os.path.exists(output_path):
+            os.unlink(output_path)
+        os.rename(tmp_path, output_path)
+
+
+def render_rss(cache, lang, title, link, description, posts, output_path,
+    deterministic=False):
+    """Write a RSS 2.0 feed with posts to output_path."""
+    posts = _sorted_posts(posts, deterministic)
+    build_date = _build_date(posts, deterministic, datetime.datetime.now)
+    tmp_path = output_path + '.tmp'
+    with _open_feed(tmp_path) as feed:
+        feed.write(u'<?xml version="1.0" encoding="utf-8"?>\n'
+            u'<rss version="2.0"><channel>'
+            u'<title>%s</title>'
+            u'<link>%s</link>'
+            u'<description>%s</description>'
+            u'<lastBuildDate>%s</lastBuildDate>'
+            u'<generator>nikola</generator>'
+            u'<docs>http://blogs.law.harvard.edu/tech/rss</docs>' % (
+                escape(title), escape(link), escape(description),
+                rfc822_date(build_date)))
+        for post in posts:
+            feed.write(cache.rss_item(post, lang))
+        feed.write(u'</channel></rss>\n')
+    _replace_if_changed(tmp_path, output_path)
+
+
+def render_atom(cache, lang, title, link, feed_url, author, posts,
+    output_path, deterministic=False):
+    """Write an Atom feed with posts to output_path.
+
+    feed_url is the absolute URL the feed itself will have.
+    """
+    posts = _sorted_posts(posts, deterministic)
+    build_date = _build_date(posts, deterministic, datetime.datetime.utcnow)
+    tmp_path = output_path + '.tmp'
+    with _open_feed(tmp_path) as feed:
+        feed.write(u'<?xml version="1.0" encoding="utf-8"?>\n'
+            u'<feed xmlns="http://www.w3.org/2005/Atom" xml:lang=%s>'
+            u'<title>%s</title>'
+            u'<link href=%s/>'
+            u'<link rel="self" href=%s/>'
+            u'<id>%s</id>'
+            u'<updated>%s</updated>'
+            u'<author><name>%s</name></author>'
+            u'<generator>nikola</generator>' % (
+                quoteattr(lang), escape(title), quoteattr(link),
+                quoteattr(feed_url), escape(feed_url),
+                rfc3339_date(build_date), escape(author)))
+        for post in posts:
+            feed.write(cache.atom_entry(post, lang))
+        feed.write(u'</feed>\n')
+    _replace_if_changed(tmp_path, output_path)
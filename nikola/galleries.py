@@ -0,0 +1,382 @@
+"""Image processing for galleries.
+
+Each image can have several derivatives: a thumbnail and scaled down
+copies at a list of widths. They are all made from a single decode of
+the image, done with PIL in draft mode for JPEG files (the decoder
+scales down while reading, which is much faster than a full decode).
+Images are processed by a pool of processes.
+
+Derivatives are kept in a cache folder keyed by the source's MD5 and
+the derivative's size, so a derivative is only made again if its
+source changes, and adding a size makes only the new derivatives.
+
+Galleries are found with find_galleries(), in a single walk of the
+galleries folder. Each folder in it is a gallery, and may contain
+other galleries.
+
+Image metadata (dimensions, EXIF capture date and orientation) is kept
+in a similar cache, so galleries can be laid out and sorted without
+opening images that didn't change.
+"""
+
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+
+import utils
+
+__all__ = ['get_image_module', 'create_derivatives', 'ThumbnailCache',
+    'ImageInfoCache', 'Gallery', 'find_galleries']
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# EXIF tags
+ORIENTATION = 274
+DATE_TIME = 306
+DATE_TIME_ORIGINAL = 36867
+
+
+def get_image_module():
+    """Return PIL's Image module, or None if PIL is not installed."""
+    try:
+        import Image
+        return Image
+    except ImportError:
+        try:
+            from PIL import Image
+            return Image
+        except ImportError:
+            return None
+
+
+def fit(size, box):
+    """Return size scaled down to fit box, keeping the aspect ratio.
+
+    box is (width, height); a height of None means only the width
+    matters. Images are never scaled up.
+    """
+    width, height = size
+    ratio = float(box[0]) / width
+    if box[1] is not None:
+        ratio = min(ratio, float(box[1]) / height)
+    ratio = min(ratio, 1.0)
+    return (max(int(round(width * ratio)), 1),
+        max(int(round(height * ratio)), 1))
+
+
+def create_images(src, outputs):
+    """Save derivatives of src from one decode.
+
+    outputs is a list of (destination, box) pairs, see fit().
+    """
+    Image = get_image_module()
+    im = Image.open(src)
+    sizes = [(fit(im.size, box), dst) for dst, box in outputs]
+    sizes.sort(reverse=True)
+    if im.format == 'JPEG':
+        # Let the decoder scale down by 1/2, 1/4 or 1/8 while reading.
+        im.draft(im.mode, sizes[0][0])
+    # Each derivative is scaled from the previous, larger one.
+    for size, dst in sizes:
+        if im.size != size:
+            im = im.resize(size, Image.ANTIALIAS)
+        im.save(dst)
+
+
+def _cache_derivatives(args):
+    """Make the derivatives of an image missing from a ThumbnailCache.
+
+    args is (folder, src, digest, boxes), where digest is None if it is
+    not known yet. Runs in the pool, so sources are hashed in parallel
+    too. Returns the digest.
+    """
+    folder, src, digest, boxes = args
+    if digest is None:
+        digest = file_digest(src)
+    outputs = [(derivative_path(folder, src, digest, box), box)
+        for box in boxes]
+    outputs = [(dst, box) for dst, box in outputs if not os.path.isfile(dst)]
+    if outputs:
+        cache_dir = os.path.dirname(outputs[0][0])
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another worker may have made it
+            if not os.path.isdir(cache_dir):
+                raise
+        create_images(src, outputs)
+    return digest
+
+
+def file_digest(path):
+    """Return the MD5 hex digest of a file's contents."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as in_file:
+        while True:
+            data = in_file.read(1 << 20)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def derivative_path(folder, src, digest, box):
+    """Where the derivative of src that fits box goes in a cache folder."""
+    ext = os.path.splitext(src)[1].lower()
+    return os.path.join(folder, digest[:2],
+        '%s-%sx%s%s' % (digest, box[0], box[1] or '', ext))
+
+
+def _is_copy(src, dst):
+    """True if dst was copied from src, as utils.copy_file does it."""
+    try:
+        src_stat = os.stat(src)
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    return (src_stat.st_size == dst_stat.st_size and
+        int(src_stat.st_mtime) == int(dst_stat.st_mtime))
+
+
+class ThumbnailCache(object):
+    """Derivatives stored by source digest and size in cache_folder.
+
+    Source digests are remembered by path, mtime and size in an index
+    file, so unchanged images are not read again to be hashed.
+    """
+
+    def __init__(self, cache_folder):
+        self.folder = os.path.join(cache_folder, 'thumbnails')
+        self.index_path = os.path.join(self.folder, 'index.json')
+        self.digests = self._load()
+
+    def _load(self):
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'rb') as index_file:
+                try:
+                    return json.load(index_file)
+                except ValueError:
+                    # Unreadable, so images are just hashed again
+                    pass
+        return {}
+
+    def known_digest(self, src, stat):
+        """The digest of src, if it was hashed with this mtime and size."""
+        entry = self.digests.get(src)
+        if entry and entry[:2] == [stat.st_mtime, stat.st_size]:
+            return entry[2]
+        return None
+
+    def remember(self, src, stat, digest):
+        self.digests[src] = [stat.st_mtime, stat.st_size, digest]
+
+    def path(self, src, digest, box):
+        """Where the derivative of src that fits box is stored."""
+        return derivative_path(self.folder, src, digest, box)
+
+    def save(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        # Galleries may be done at the same time ("doit -n"), so keep
+        # what others saved since this index was loaded.
+        digests = self._load()
+        digests.update(self.digests)
+        # Write a new file and move it into place, so an interrupted
+        # build never leaves a truncated index behind.
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder)
+        with os.fdopen(fd, 'wb') as index_file:
+            json.dump(digests, index_file)
+        try:
+            os.rename(tmp_path, self.index_path)
+        except OSError:
+            # Windows doesn't replace existing files
+            os.unlink(self.index_path)
+            os.rename(tmp_path, self.index_path)
+        self.digests = digests
+
+
+def create_derivatives(jobs, cache_folder, processes=None,
+    copy_strategy='copy'):
+    """Create image derivatives.
+
+    jobs is a list of (source, outputs) where outputs is a list of
+    (destination, box) pairs, see fit(). Sources that are new or changed
+    are hashed and their derivatives missing from the cache are created
+    using a pool of processes (by default, one per CPU). Then they are
+    copied to the destinations that don't have them yet, with
+    utils.copy_file.
+    """
+    if get_image_module() is None:
+        for src, outputs in jobs:
+            for dst, _ in outputs:
+                utils.copy_file(src, dst, copy_strategy)
+        return
+    cache = ThumbnailCache(cache_folder)
+    stats = {}
+    digests = {}
+    work = []
+    for src, outputs in jobs:
+        boxes = sorted(set(box for _, box in outputs))
+        stats[src] = os.stat(src)
+        digest = cache.known_digest(src, stats[src])
+        if digest is not None and all(os.path.isfile(cache.path(src,
+                digest, box)) for box in boxes):
+            digests[src] = digest
+        else:
+            work.append((cache.folder, src, digest, boxes))
+    if processes == 1 or len(work) < 2:
+        results = map(_cache_derivatives, work)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_cache_derivatives, work)
+        finally:
+            pool.close()
+            pool.join()
+    for (_, src, _, _), digest in zip(work, results):
+        digests[src] = digest
+        cache.remember(src, stats[src], digest)
+    # The task runs again for a whole gallery when one image changes, but
+    # the others' derivatives are still in place and are not copied again.
+    for src, outputs in jobs:
+        for dst, box in outputs:
+            cache_path = cache.path(src, digests[src], box)
+            if not _is_copy(cache_path, dst):
+                utils.copy_file(cache_path, dst, copy_strategy)
+    cache.save()
+
+
+def read_info(path):
+    """Return (width, height, date, orientation) for an image.
+
+    Only the image header is read, not the pixels. date is the EXIF
+    capture date as "YYYY-MM-DD HH:MM:SS", or None, and orientation is
+    the EXIF orientation (1 when unknown).
+    """
+    Image = get_image_module()
+    if Image is None:
+        return None, None, None, 1
+    im = Image.open(path)
+    exif = {}
+    if hasattr(im, '_getexif'):
+        try:
+            exif = im._getexif() or {}
+        except Exception:
+            # Broken EXIF data is common enough, and not worth failing for
+            pass
+    date = exif.get(DATE_TIME_ORIGINAL) or exif.get(DATE_TIME)
+    try:
+        date = datetime.datetime.strptime(date.strip('\x00 '),
+            '%Y:%m:%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:%S')
+    except (AttributeError, TypeError, ValueError):
+        date = None
+    width, height = im.size
+    return width, height, date, exif.get(ORIENTATION, 1)
+
+
+class ImageInfoCache(object):
+    """Image metadata stored by path, mtime and size in cache_folder.
+
+    info() returns a dict with width, height, date (a datetime, or None)
+    and orientation.
+    """
+
+    def __init__(self, cache_folder):
+        self.path = os.path.join(cache_folder, 'images.json')
+        self.entries = {}
+        self.changed = False
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as cache_file:
+                try:
+                    self.entries = json.load(cache_file)
+                except ValueError:
+                    # Unreadable, so images are just read again
+                    pass
+
+    def info(self, src):
+        stat = os.stat(src)
+        entry = self.entries.get(src)
+        if not entry or entry[:2] != [stat.st_mtime, stat.st_size]:
+            entry = [stat.st_mtime, stat.st_size] + list(read_info(src))
+            self.entries[src] = entry
+            self.changed = True
+        width, height, date, orientation = entry[2:]
+        if date is not None:
+            date = datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+        return {
+            'width': width,
+            'height': height,
+            'date': date,
+            'orientation': orientation,
+        }
+
+    def save(self):
+        if not self.changed:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Like the thumbnail index, never leave a truncated file behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            json.dump(self.entries, cache_file)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+
+
+def is_image(file_name):
+    """True if file_name is an image that belongs in a gallery.
+
+    Extensions are matched ignoring case, and thumbnails left over from
+    old versions of Nikola (which wrote them next to the images) are
+    skipped.
+    """
+    stem, ext = os.path.splitext(file_name)
+    return (ext.lower() in IMAGE_EXTENSIONS and
+        not stem.endswith('.thumbnail'))
+
+
+class Gallery(object):
+    """A folder of images.
+
+    path is the folder ("galleries/trips/rome"), name is the path
+    relative to the galleries folder, with "/" as separator
+    ("trips/rome"), images is the sorted list of image paths, children
+    is the list of names of the galleries inside this one, and
+    index_txt is the path of its index.txt, or None.
+    """
+
+    def __init__(self, path, name, images, children, index_txt):
+        self.path = path
+        self.name = name
+        self.images = images
+        self.children = children
+        self.index_txt = index_txt
+
+
+def find_galleries(root):
+    """Return the galleries inside the root folder.
+
+    The folder tree is walked once. Parents come before their
+    children, and siblings are sorted by name. Hidden folders are
+    skipped.
+    """
+    found = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith('.'))
+        if dir_path == root:
+            continue
+        name = os.path.relpath(dir_path, root).replace(os.sep, '/')
+        images = sorted(os.path.join(dir_path, f) for f in file_names
+            if is_image(f))
+        index_txt = None
+        if 'index.txt' in file_names:
+            index_txt = os.path.join(dir_path, 'index.txt')
+        found.append(Gallery(dir_path, name, images,
+            [name + '/' + d for d in dir_names], index_txt))
+    return found
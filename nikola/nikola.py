@@ -11,13 +11,17 @@ import json
 import os
 from StringIO import StringIO
 import sys
-import tempfile
 import urllib2
 import urlparse
 
 from doit.tools import PythonInteractiveAction, run_once
 
 import nikola
+import assets
+import cssprune
+import feeds
+import galleries
+import sitemaps
 import utils
 
 __all__ = ['Nikola', 'nikola_main']
@@ -41,14 +45,15 @@ class config_changed(object):
             raise Exception(('Invalid type of config_changed parameter got %s' +
                              ', must be string or dict') % (type(self.config),))
 
+        # The digest is part of the key, so several config_changed
+        # can be used in the same task without overwriting each other.
+        key = '_config_changed:' + config_digest
+
         def _save_config():
-            return {'_config_changed': config_digest}
+            return {key: True}
 
         task.insert_action(_save_config)
-        last_success = values.get('_config_changed')
-        if last_success is None:
-            return False
-        return (last_success == config_digest)
+        return key in values
 
 class Post(object):
 
@@ -135,6 +140,16 @@ class Post(object):
         deps += self.fragment_deps(lang)
         return deps
 
+    def metadata_digest(self, lang):
+        """Return a digest of the metadata shown in lists of posts.
+
+        Pages that only list posts (archives, tag pages) depend on this
+        instead of deps(), so editing a post's body doesn't rebuild them.
+        """
+        data = cPickle.dumps((self.post_name, self.title(lang), self.date,
+            self.permalink(lang), self.tags, self.link))
+        return hashlib.md5(data).hexdigest()
+
     def fragment_deps(self, lang):
         """Return a list of dependencies to build this post's fragment."""
         #deps = [self.source_path, self.metadata_path]
@@ -191,6 +206,12 @@ class Nikola(object):
         self.timeline = []
         self.pages = []
         self._scanned = False
+        self._galleries = None
+        self._bundles = None
+        # Pages for the sitemap: output path -> last modification date
+        self.sitemap_pages = {}
+        self._fragment_cache = {}
+        self.feed_cache = feeds.FeedItemCache()
 
         # This is the default config
         # TODO: fill it
@@ -198,6 +219,45 @@ class Nikola(object):
             'OUTPUT_FOLDER': 'output',
             'FILES_FOLDERS': ('files', ),
             'ADD_THIS_BUTTONS': True,
+            'INDEX_DISPLAY_POST_COUNT': 10,
+            'INDEXES_STATIC': False,
+            'FEED_LENGTH': 10,
+            'DETERMINISTIC_FEEDS': False,
+            'GZIP_FILES': False,
+            'GZIP_EXTENSIONS': ('.txt', '.htm', '.html', '.css', '.js',
+                '.json', '.xml', '.atom', '.svg'),
+            'GZIP_MIN_SIZE': 1024,
+            'CACHE_FOLDER': 'cache',
+            'THUMBNAIL_PROCESSES': None,
+            'GALLERY_IMAGE_WIDTHS': (),
+            'GALLERY_SORT_BY_DATE': False,
+            'GALLERY_PAGE_SIZE': 0,
+            'COPY_STRATEGY': 'copy',
+            'PRUNE_CSS': False,
+            'PRUNE_CSS_FILES': (
+                'assets/css/bootstrap.css',
+                'assets/css/bootstrap-responsive.css',
+            ),
+            'PRUNE_CSS_ALLOWLIST': (
+                'active', 'collapse', 'fade', 'in', 'open',
+                'dropdown*', 'modal*', 'popover*', 'tooltip*',
+            ),
+            'SITEMAP_LASTMOD': 'date',
+            'USE_BUNDLES': False,
+            'BUNDLES': {
+                'assets/css/all.css': [
+                    'assets/css/bootstrap.css',
+                    'assets/css/bootstrap-responsive.css',
+                    'assets/css/rst.css',
+                    'assets/css/code.css',
+                    'assets/css/custom.css',
+                ],
+                'assets/js/gallery.js': [
+                    'assets/js/jquery-1.7.2.min.js',
+                    'assets/js/jquery.colorbox-min.js',
+                ],
+            },
+            'BLOG_AUTHOR': '',
             'post_compilers': {
                 "rest":     ['.txt', '.rst'],
                 "markdown": ['.md', '.mdown', '.markdown']
@@ -214,7 +274,6 @@ class Nikola(object):
 
         self.templates_module = utils.get_template_module(
             self.config['TEMPLATE_ENGINE'], self.THEMES)
-        self.template_deps = self.templates_module.template_deps
 
         self.MESSAGES = utils.load_messages(self.THEMES,
             self.config['TRANSLATIONS'])
@@ -223,6 +282,9 @@ class Nikola(object):
         self.GLOBAL_CONTEXT['_link'] = self.link
         self.GLOBAL_CONTEXT['rel_link'] = self.rel_link
         self.GLOBAL_CONTEXT['exists'] = self.file_exists
+        self.GLOBAL_CONTEXT['cached_fragment'] = self.cached_fragment
+        self.GLOBAL_CONTEXT['asset_url'] = self.asset_url
+        self.GLOBAL_CONTEXT['use_bundles'] = self.config['USE_BUNDLES']
         self.GLOBAL_CONTEXT['add_this_buttons'] = self.config[
             'ADD_THIS_BUTTONS']
 
@@ -231,6 +293,61 @@ class Nikola(object):
             if isinstance(v, (str, unicode, int, float, dict)):
                 self.DEPS_CONTEXT[k] = v
 
+    def template_deps(self, template_name):
+        deps = self.templates_module.template_deps(template_name)
+        if self.config['USE_BUNDLES']:
+            # Pages have to be rendered again when bundle names change
+            deps = deps + [self.manifest_path()]
+        return deps
+
+    def manifest_path(self):
+        return os.path.join(self.config['OUTPUT_FOLDER'], 'assets',
+            'manifest.json')
+
+    def asset_source(self, name):
+        """Find the file that will be copied to output/name.
+
+        Files in FILES_FOLDERS win over theme assets, and newer
+        themes win over their parents. Returns None if there is none.
+        """
+        folders = list(self.config['FILES_FOLDERS'])
+        for theme_name in self.THEMES:
+            folders.append(utils.get_theme_path(theme_name))
+        for folder in folders:
+            path = os.path.join(folder, *name.split('/'))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def scan_bundles(self):
+        """Find the files in each bundle, and the bundle's hashed name.
+
+        Returns a dictionary of logical name to (hashed name, sources).
+        Missing files are left out, and so are empty bundles.
+        """
+        if self._bundles is None:
+            self._bundles = {}
+            for name, members in self.config['BUNDLES'].items():
+                sources = filter(None, map(self.asset_source, members))
+                if sources:
+                    digest = assets.sources_digest(sources)
+                    self._bundles[name] = (
+                        assets.hashed_name(name, digest), sources)
+        return self._bundles
+
+    def asset_url(self, name):
+        """Resolve a logical asset name, like "/assets/css/all.css".
+
+        If bundles are used and name is a bundle, return the bundle's
+        hashed name, otherwise return name.
+        """
+        if not self.config['USE_BUNDLES']:
+            return name
+        bundle = self.scan_bundles().get(name.lstrip('/'))
+        if bundle is None:
+            return name
+        return name[:len(name) - len(name.lstrip('/'))] + bundle[0]
+
     def render_template(self, template_name, output_name, context):
             self.templates_module.render_template(
                 template_name, output_name, context, self.GLOBAL_CONTEXT)
@@ -243,9 +360,11 @@ class Nikola(object):
         * tag_index (name is ignored)
         * tag (and name is the tag name)
         * tag_rss (name is the tag name)
+        * tag_atom (name is the tag name)
         * archive (and name is the year, or None for the main archive index)
         * index (name is the number in index-number)
         * rss (name is ignored)
+        * atom (name is ignored)
         * gallery (name is the gallery name)
 
         The returned value is always a path relative to output, like
@@ -269,6 +388,9 @@ class Nikola(object):
         elif kind == "tag_rss":
             path = filter(None, [self.config['TRANSLATIONS'][lang],
             self.config['TAG_PATH'], name + ".xml"])
+        elif kind == "tag_atom":
+            path = filter(None, [self.config['TRANSLATIONS'][lang],
+            self.config['TAG_PATH'], name + ".atom"])
         elif kind == "index":
             if name > 0:
                 path = filter(None, [self.config['TRANSLATIONS'][lang],
@@ -279,6 +401,9 @@ class Nikola(object):
         elif kind == "rss":
             path = filter(None, [self.config['TRANSLATIONS'][lang],
             self.config['RSS_PATH'], 'rss.xml'])
+        elif kind == "atom":
+            path = filter(None, [self.config['TRANSLATIONS'][lang],
+            self.config['RSS_PATH'], 'atom.xml'])
         elif kind == "archive":
             if name:
                 path = filter(None, [self.config['TRANSLATIONS'][lang],
@@ -321,6 +446,25 @@ class Nikola(object):
         # Now i is the longest common prefix
         return '/'.join(['..'] * (len(src_elems) - i - 1) + dst_elems[i:])
 
+    def cached_fragment(self, name, lang, permalink, render):
+        """Render a shared page fragment once per language and folder depth.
+
+        `render` is a callable that takes a permalink and returns the
+        fragment's text. It is called with a placeholder permalink at the
+        same depth as the real one, so links made with rel_link in it are
+        valid for every page at that depth. The fragment must not depend
+        on anything else specific to the page.
+        """
+        path = urlparse.urlsplit(
+            urlparse.urljoin(self.config['BLOG_URL'], permalink)).path
+        depth = max(len(path.split('/')) - 2, 0)
+        key = (name, lang, depth)
+        if key not in self._fragment_cache:
+            fake_permalink = '/' + '/'.join(
+                ['__fragment__'] * depth + ['__fragment__.html'])
+            self._fragment_cache[key] = render(fake_permalink)
+        return self._fragment_cache[key]
+
     def file_exists(self, path, not_empty=False):
         """Returns True if the file exists. If not_empty is True,
         it also has to be not empty."""
@@ -335,58 +479,122 @@ class Nikola(object):
         yield self.task_install_theme()
         yield self.gen_task_new_post(self.config['post_pages'])
         yield self.gen_task_new_page(self.config['post_pages'])
-        yield self.gen_task_copy_assets(themes=self.THEMES,
-            output_folder=self.config['OUTPUT_FOLDER'])
         yield self.gen_task_deploy(commands=self.config['DEPLOY_COMMANDS'])
+        # Tasks that write into the output folder. Their targets are
+        # collected so they can be compressed afterwards.
+        output_tasks = [
+            self.gen_task_copy_assets(themes=self.THEMES,
+                output_folder=self.config['OUTPUT_FOLDER'],
+                copy_strategy=self.config['COPY_STRATEGY']),
+            self.gen_task_render_pages(
+                translations=self.config['TRANSLATIONS'],
+                post_pages=self.config['post_pages']),
+            self.gen_task_render_sources(
+                translations=self.config['TRANSLATIONS'],
+                default_lang=self.config['DEFAULT_LANG'],
+                output_folder=self.config['OUTPUT_FOLDER'],
+                post_pages=self.config['post_pages'],
+                copy_strategy=self.config['COPY_STRATEGY']),
+            self.gen_task_render_posts(
+                translations=self.config['TRANSLATIONS'],
+                default_lang=self.config['DEFAULT_LANG'],
+                timeline=self.timeline),
+            self.gen_task_render_indexes(
+                translations=self.config['TRANSLATIONS'],
+                output_folder=self.config['OUTPUT_FOLDER'],
+                index_display_post_count=self.config[
+                    'INDEX_DISPLAY_POST_COUNT'],
+                indexes_static=self.config['INDEXES_STATIC']),
+            self.gen_task_render_archive(
+                translations=self.config['TRANSLATIONS'],
+                messages=self.MESSAGES,
+                output_folder=self.config['OUTPUT_FOLDER']),
+            self.gen_task_render_tags(
+                translations=self.config['TRANSLATIONS'],
+                messages=self.MESSAGES,
+                blog_title=self.config['BLOG_TITLE'],
+                blog_url=self.config['BLOG_URL'],
+                blog_description=self.config['BLOG_DESCRIPTION'],
+                blog_author=self.config['BLOG_AUTHOR'],
+                feed_length=self.config['FEED_LENGTH'],
+                deterministic_feeds=self.config['DETERMINISTIC_FEEDS'],
+                output_folder=self.config['OUTPUT_FOLDER']),
+            self.gen_task_render_rss(
+                translations=self.config['TRANSLATIONS'],
+                blog_title=self.config['BLOG_TITLE'],
+                blog_url=self.config['BLOG_URL'],
+                blog_description=self.config['BLOG_DESCRIPTION'],
+                blog_author=self.config['BLOG_AUTHOR'],
+                feed_length=self.config['FEED_LENGTH'],
+                deterministic_feeds=self.config['DETERMINISTIC_FEEDS'],
+                output_folder=self.config['OUTPUT_FOLDER']),
+            self.gen_task_render_galleries(
+                thumbnail_size=self.config['THUMBNAIL_SIZE'],
+                image_widths=self.config['GALLERY_IMAGE_WIDTHS'],
+                thumbnail_processes=self.config['THUMBNAIL_PROCESSES'],
+                sort_by_date=self.config['GALLERY_SORT_BY_DATE'],
+                page_size=self.config['GALLERY_PAGE_SIZE'],
+                cache_folder=self.config['CACHE_FOLDER'],
+                copy_strategy=self.config['COPY_STRATEGY'],
+                default_lang=self.config['DEFAULT_LANG'],
+                output_folder=self.config['OUTPUT_FOLDER']),
+            self.gen_task_redirect(
+                redirections=self.config['REDIRECTIONS'],
+                output_folder=self.config['OUTPUT_FOLDER']),
+            self.gen_task_copy_files(
+                output_folder=self.config['OUTPUT_FOLDER'],
+                files_folders=self.config['FILES_FOLDERS'],
+                copy_strategy=self.config['COPY_STRATEGY']),
+        ]
+        bundles = {}
+        if self.config['USE_BUNDLES']:
+            bundles = self.scan_bundles()
+        output_tasks.append(self.gen_task_bundles(
+            bundles=bundles,
+            manifest_path=self.manifest_path(),
+            output_folder=self.config['OUTPUT_FOLDER']))
+        pruned_css = {}
+        if self.config['PRUNE_CSS']:
+            for name in self.config['PRUNE_CSS_FILES']:
+                src = self.asset_source(name)
+                if src:
+                    pruned_css[os.path.join(self.config['OUTPUT_FOLDER'],
+                        *name.split('/'))] = src
+        output_files = []
+        for tasks in output_tasks:
+            for task in tasks:
+                # Pruned stylesheets are written by prune_css instead
+                if task.get('basename') in ('copy_assets', 'copy_files') and \
+                        set(task.get('targets', [])) & set(pruned_css):
+                    continue
+                output_files += task.get('targets', [])
+                yield task
+        for task in self.gen_task_prune_css(
+                stylesheets=sorted((src, dst)
+                    for dst, src in pruned_css.items()),
+                output_files=output_files,
+                output_folder=self.config['OUTPUT_FOLDER'],
+                allowlist=self.config['PRUNE_CSS_ALLOWLIST'],
+                cache_folder=self.config['CACHE_FOLDER']):
+            output_files += task.get('targets', [])
+            yield task
+        # The renderers have recorded their pages by now
         yield self.gen_task_sitemap(blog_url=self.config['BLOG_URL'],
-            output_folder=self.config['OUTPUT_FOLDER']
-        )
-        yield self.gen_task_render_pages(
-            translations=self.config['TRANSLATIONS'],
-            post_pages=self.config['post_pages'])
-        yield self.gen_task_render_sources(
-            translations=self.config['TRANSLATIONS'],
-            default_lang=self.config['DEFAULT_LANG'],
             output_folder=self.config['OUTPUT_FOLDER'],
-            post_pages=self.config['post_pages'])
-        yield self.gen_task_render_posts(
-            translations=self.config['TRANSLATIONS'],
-            default_lang=self.config['DEFAULT_LANG'],
-            timeline=self.timeline
-            )
-        yield self.gen_task_render_indexes(
-            translations=self.config['TRANSLATIONS'],
-            output_folder=self.config['OUTPUT_FOLDER'])
-        yield self.gen_task_render_archive(
-            translations=self.config['TRANSLATIONS'],
-            messages=self.MESSAGES,
-            output_folder=self.config['OUTPUT_FOLDER'])
-        yield self.gen_task_render_tags(
-            translations=self.config['TRANSLATIONS'],
-            messages=self.MESSAGES,
-            blog_title=self.config['BLOG_TITLE'],
-            blog_url=self.config['BLOG_URL'],
-            blog_description=self.config['BLOG_DESCRIPTION'],
-            output_folder=self.config['OUTPUT_FOLDER'])
-        yield self.gen_task_render_rss(
-            translations=self.config['TRANSLATIONS'],
-            blog_title=self.config['BLOG_TITLE'],
-            blog_url=self.config['BLOG_URL'],
-            blog_description=self.config['BLOG_DESCRIPTION'],
-            output_folder=self.config['OUTPUT_FOLDER'])
-        yield self.gen_task_render_galleries(
-            thumbnail_size=self.config['THUMBNAIL_SIZE'],
-            default_lang=self.config['DEFAULT_LANG'],
-            output_folder=self.config['OUTPUT_FOLDER'])
-        yield self.gen_task_redirect(
-            redirections=self.config['REDIRECTIONS'],
-            output_folder=self.config['OUTPUT_FOLDER'])
-        yield self.gen_task_copy_files(
+            pages=self.sitemap_pages,
+            lastmod=self.config['SITEMAP_LASTMOD'],
+            cache_folder=self.config['CACHE_FOLDER'])
+        yield self.gen_task_gzip(
+            output_files=output_files,
             output_folder=self.config['OUTPUT_FOLDER'],
-            files_folders=self.config['FILES_FOLDERS'])
+            gzip_files=self.config['GZIP_FILES'],
+            gzip_extensions=self.config['GZIP_EXTENSIONS'],
+            gzip_min_size=self.config['GZIP_MIN_SIZE'])
         yield {
             'name': 'all',
-            'actions': None,
+            'actions': [(utils.copy_summary,
+                (self.config['COPY_STRATEGY'],))],
+            'verbosity': 2,
             'clean': True,
             'task_dep': [
                 'render_archive',
@@ -399,11 +607,20 @@ class Nikola(object):
                 'render_tags',
                 'copy_assets',
                 'copy_files',
+                'bundles',
+                'prune_css',
                 'sitemap',
                 'redirect',
+                'gzip',
                 ],
             }
 
+    def scan_galleries(self):
+        """Find all the galleries, walking the galleries folder once."""
+        if self._galleries is None:
+            self._galleries = galleries.find_galleries("galleries")
+        return self._galleries
+
     def scan_posts(self):
         """Scan all the posts."""
         if not self._scanned:
@@ -423,7 +640,9 @@ class Nikola(object):
                         self.pages.append(post)
             for name, post in self.global_data.items():
                 self.timeline.append(post)
-            self.timeline.sort(cmp=lambda a, b: cmp(a.date, b.date))
+            # Break ties by name, so the order doesn't depend on
+            # the order of files on disk.
+            self.timeline.sort(key=lambda p: (p.date, p.post_name))
             self.timeline.reverse()
             for i, p in enumerate(self.timeline[1:]):
                 p.next_post = self.timeline[i]
@@ -452,8 +671,18 @@ class Nikola(object):
                 self.config['TRANSLATIONS'][lang],
                 destination,
                 post.pagenames[lang] + ".html")
+            self.sitemap_pages[output_name] = post.date
             deps_dict = copy(context)
-            deps_dict.pop('post')
+            # Post objects link to the whole timeline, so fingerprint
+            # only what this page shows: the post's own metadata and
+            # the previous/next links.
+            deps_dict['post'] = post.metadata_digest(lang)
+            deps_dict['neighbors'] = [(p.post_name, p.title(lang),
+                p.permalink(lang)) if p else None
+                for p in (post.prev_post, post.next_post)]
+            # No template shows the list of stories, so adding or
+            # removing one must not render every page again.
+            del deps_dict['pages']
             deps_dict['OUTPUT_FOLDER']=self.config['OUTPUT_FOLDER']
             deps_dict['TRANSLATIONS']=self.config['TRANSLATIONS']
             yield {
@@ -493,6 +722,7 @@ class Nikola(object):
         default_lang
         post_pages
         output_folder
+        copy_strategy
         """
         self.scan_posts()
         for lang in kw["translations"]:
@@ -510,7 +740,8 @@ class Nikola(object):
                     'name': output_name.encode('utf8'),
                     'file_dep': [source],
                     'targets': [output_name],
-                    'actions': [(utils.copy_file, (source, output_name))],
+                    'actions': [(utils.copy_file,
+                        (source, output_name, kw["copy_strategy"]))],
                     'clean': True,
                     'uptodate': [config_changed(kw)],
                     }
@@ -548,43 +779,41 @@ class Nikola(object):
                 }
 
     def gen_task_render_indexes(self, **kw):
-        """Render 10-post-per-page indexes.
+        """Render post-per-page indexes.
+
+        The number of posts per page is index_display_post_count.
+
+        If indexes_static is True, the numbered pages are anchored to
+        the oldest posts: index-1.html has the oldest ones, and adding a
+        post only changes index.html and the newest numbered page.
+        Otherwise index-1.html has the posts right after the front page.
 
         Required keyword arguments:
 
         translations
         output_folder
+        index_display_post_count
+        indexes_static
         """
         self.scan_posts()
         template_name = "index.tmpl"
         # TODO: timeline is global, get rid of it
         posts = [x for x in self.timeline if x.use_in_feeds]
-        # Split in smaller lists
-        lists = []
-        while posts:
-            lists.append(posts[:10])
-            posts = posts[10:]
-        num_pages = len(lists)
-        if not lists:
+        page_size = kw['index_display_post_count']
+        if kw['indexes_static']:
+            index_pages = self.static_index_pages(posts, page_size)
+        else:
+            index_pages = self.index_pages(posts, page_size)
+        if not index_pages:
             yield {
                 'basename': 'render_indexes',
                 'actions': [],
                 }
         for lang in kw["translations"]:
-            for i, post_list in enumerate(lists):
+            for i, post_list, prevlink, nextlink in index_pages:
                 context = {}
-                if not i:
-                    output_name = "index.html"
-                else:
-                    output_name = "index-%s.html" % i
-                context["prevlink"] = None
-                context["nextlink"] = None
-                if i > 1:
-                    context["prevlink"] = "index-%s.html" % (i - 1)
-                if i == 1:
-                    context["prevlink"] = "index.html"
-                if i < num_pages - 1:
-                    context["nextlink"] = "index-%s.html" % (i + 1)
+                context["prevlink"] = prevlink
+                context["nextlink"] = nextlink
                 context["permalink"] = self.link("index", i, lang)
                 output_name = os.path.join(
                     kw['output_folder'], self.path("index", i, lang))
@@ -594,19 +823,81 @@ class Nikola(object):
                     output_name,
                     template_name,
                     context,
+                    kw=kw,
                 )
-                task['uptodate'] = task.get('updtodate', []) +\
-                    [config_changed(kw)]
                 task['basename'] = 'render_indexes'
                 yield task
 
+    @staticmethod
+    def index_page_name(i):
+        if not i:
+            return "index.html"
+        return "index-%s.html" % i
+
+    def index_pages(self, posts, page_size):
+        """Split posts (newest first) into index pages.
+
+        Returns a list of (number, posts, prevlink, nextlink), where
+        page 0 is index.html and has the newest posts. Gallery pages
+        are split the same way.
+        """
+        lists = [posts[i:i + page_size]
+            for i in xrange(0, len(posts), page_size)]
+        num_pages = len(lists)
+        pages = []
+        for i, post_list in enumerate(lists):
+            prevlink = None
+            nextlink = None
+            if i > 0:
+                prevlink = self.index_page_name(i - 1)
+            if i < num_pages - 1:
+                nextlink = self.index_page_name(i + 1)
+            pages.append((i, post_list, prevlink, nextlink))
+        return pages
+
+    def static_index_pages(self, posts, page_size):
+        """Split posts (newest first) into stable index pages.
+
+        Numbered pages are filled starting from the oldest post, so
+        their contents don't move when new posts are added. Page 0
+        (index.html) always has the newest page_size posts.
+
+        Returns a list of (number, posts, prevlink, nextlink).
+        """
+        oldest_first = posts[::-1]
+        lists = [oldest_first[i:i + page_size][::-1]
+            for i in xrange(0, len(oldest_first), page_size)]
+        num_pages = len(lists)
+        if not num_pages:
+            return []
+        nextlink = None
+        if num_pages > 1:
+            nextlink = self.index_page_name(num_pages - 1)
+        pages = [(0, posts[:page_size], None, nextlink)]
+        for i, post_list in enumerate(lists, 1):
+            prevlink = self.index_page_name(0)
+            nextlink = None
+            if i < num_pages:
+                prevlink = self.index_page_name(i + 1)
+            if i > 1:
+                nextlink = self.index_page_name(i - 1)
+            pages.append((i, post_list, prevlink, nextlink))
+        return pages
+
     def generic_post_list_renderer(self, lang, posts,
-        output_name, template_name, extra_context={}):
-        """Renders pages with lists of posts."""
+        output_name, template_name, extra_context={}, with_body=True,
+        kw=None):
+        """Renders pages with lists of posts.
+
+        If with_body is False, the page doesn't show the posts' text and
+        depends only on their metadata. kw are the calling task's keyword
+        arguments, which the page also depends on.
+        """
 
         deps = self.template_deps(template_name)
-        for post in posts:
-            deps += post.deps(lang)
+        if with_body:
+            for post in posts:
+                deps += post.deps(lang)
         context = {}
         context["posts"] = posts
         context["title"] = self.config['BLOG_TITLE']
@@ -615,6 +906,17 @@ class Nikola(object):
         context["nextlink"] = None
         context['pages'] = self.pages
         context.update(extra_context)
+        # Post objects link to their neighbours, so pickling them would
+        # make this page depend on the whole timeline.
+        deps_context = copy(context)
+        deps_context["posts"] = [post.metadata_digest(lang)
+            for post in posts]
+        deps_context["pages"] = [post.post_name for post in self.pages]
+        # A task only saves the values of the checks doit got to, so it
+        # must have a single config_changed to be up to date next time.
+        deps_context["kw"] = kw
+        self.sitemap_pages[output_name] = max([post.date
+            for post in posts] or [None])
         return {
             'name': output_name.encode('utf8'),
             'targets': [output_name],
@@ -622,7 +924,7 @@ class Nikola(object):
             'actions': [(self.render_template,
                 [template_name, output_name, context])],
             'clean': True,
-            'uptodate': [config_changed(context)]
+            'uptodate': [config_changed(deps_context)]
         }
 
     def gen_task_render_archive(self, **kw):
@@ -658,9 +960,9 @@ class Nikola(object):
                     output_name,
                     template_name,
                     context,
+                    with_body=False,
+                    kw=kw,
                 )
-                task['uptodate'] = task.get('updtodate', []) +\
-                    [config_changed(kw)]
                 yield task
 
         # And global "all your years" page
@@ -681,8 +983,8 @@ class Nikola(object):
                 output_name,
                 template_name,
                 context,
+                kw=kw,
             )
-            task['uptodate'] = task.get('updtodate', []) + [config_changed(kw)]
             task['basename'] = 'render_archive'
             yield task
 
@@ -696,6 +998,9 @@ class Nikola(object):
         blog_title
         blog_url
         blog_description
+        blog_author
+        feed_length
+        deterministic_feeds
         output_folder
         """
         template_name = "list.tmpl"
@@ -721,30 +1026,51 @@ class Nikola(object):
                     output_name,
                     template_name,
                     context,
+                    with_body=False,
+                    kw=kw,
                 )
-                task['uptodate'] = task.get('updtodate', []) +\
-                    [config_changed(kw)]
                 task['basename'] = 'render_tags'
                 yield task
 
-                #Render RSS
-                output_name = os.path.join(kw['output_folder'],
-                    self.path("tag_rss", tag, lang))
-                deps = []
+                # Render feeds
                 post_list = [self.global_data[post] for post in posts
                     if self.global_data[post].use_in_feeds]
-                post_list.sort(cmp=lambda a, b: cmp(a.date, b.date))
+                # Same order as the timeline, so posts with the same date
+                # don't swap in and out of the feed between builds.
+                post_list.sort(key=lambda p: (p.date, p.post_name))
                 post_list.reverse()
+                post_list = post_list[:kw["feed_length"]]
+                deps = []
                 for post in post_list:
                     deps += post.deps(lang)
+                feed_title = "%s (%s)" % (kw["blog_title"], tag)
+                output_name = os.path.join(kw['output_folder'],
+                    self.path("tag_rss", tag, lang))
                 yield {
+                    'basename': 'render_tags',
                     'name': output_name.encode('utf8'),
                     'file_dep': deps,
                     'targets': [output_name],
-                    'actions': [(utils.generic_rss_renderer,
-                        (lang, "%s (%s)" % (kw["blog_title"], tag),
+                    'actions': [(feeds.render_rss,
+                        (self.feed_cache, lang, feed_title,
                         kw["blog_url"], kw["blog_description"],
-                        post_list, output_name))],
+                        post_list, output_name, kw["deterministic_feeds"]))],
+                    'clean': True,
+                    'uptodate': [config_changed(kw)],
+                }
+                output_name = os.path.join(kw['output_folder'],
+                    self.path("tag_atom", tag, lang))
+                feed_url = urlparse.urljoin(kw["blog_url"],
+                    self.link("tag_atom", tag, lang))
+                yield {
+                    'basename': 'render_tags',
+                    'name': output_name.encode('utf8'),
+                    'file_dep': deps,
+                    'targets': [output_name],
+                    'actions': [(feeds.render_atom,
+                        (self.feed_cache, lang, feed_title,
+                        kw["blog_url"], feed_url, kw["blog_author"],
+                        post_list, output_name, kw["deterministic_feeds"]))],
                     'clean': True,
                     'uptodate': [config_changed(kw)],
                 }
@@ -767,12 +1093,12 @@ class Nikola(object):
                 output_name,
                 template_name,
                 context,
+                kw=kw,
             )
-            task['uptodate'] = task.get('updtodate', []) + [config_changed(kw)]
             yield task
 
     def gen_task_render_rss(self, **kw):
-        """Generate RSS feeds.
+        """Generate RSS and Atom feeds.
 
         Required keyword arguments:
 
@@ -780,26 +1106,47 @@ class Nikola(object):
         blog_title
         blog_url
         blog_description
+        blog_author
+        feed_length
+        deterministic_feeds
         output_folder
         """
 
         self.scan_posts()
         # TODO: timeline is global, kill it
         for lang in kw["translations"]:
-            output_name = os.path.join(kw['output_folder'],
-                self.path("rss", None, lang))
             deps = []
-            posts = [x for x in self.timeline if x.use_in_feeds][:10]
+            posts = [x for x in self.timeline if x.use_in_feeds][
+                :kw["feed_length"]]
             for post in posts:
                 deps += post.deps(lang)
+            output_name = os.path.join(kw['output_folder'],
+                self.path("rss", None, lang))
+            yield {
+                'basename': 'render_rss',
+                'name': output_name,
+                'file_dep': deps,
+                'targets': [output_name],
+                'actions': [(feeds.render_rss,
+                    (self.feed_cache, lang, kw["blog_title"], kw["blog_url"],
+                    kw["blog_description"], posts, output_name,
+                    kw["deterministic_feeds"]))],
+                'clean': True,
+                'uptodate': [config_changed(kw)],
+            }
+            output_name = os.path.join(kw['output_folder'],
+                self.path("atom", None, lang))
+            feed_url = urlparse.urljoin(kw["blog_url"],
+                self.link("atom", None, lang))
             yield {
                 'basename': 'render_rss',
                 'name': output_name,
                 'file_dep': deps,
                 'targets': [output_name],
-                'actions': [(utils.generic_rss_renderer,
-                    (lang, kw["blog_title"], kw["blog_url"],
-                    kw["blog_description"], posts, output_name))],
+                'actions': [(feeds.render_atom,
+                    (self.feed_cache, lang, kw["blog_title"], kw["blog_url"],
+                    feed_url, kw["blog_author"], posts, output_name,
+                    kw["deterministic_feeds"]))],
                 'clean': True,
                 'uptodate': [config_changed(kw)],
             }
@@ -810,43 +1157,32 @@ class Nikola(object):
         Required keyword arguments:
 
         thumbnail_size,
+        image_widths,
+        thumbnail_processes,
+        sort_by_date,
+        page_size,
+        cache_folder,
+        copy_strategy,
         default_lang,
         output_folder
         """
         template_name = "gallery.tmpl"
 
-        gallery_list = glob.glob("galleries/*")
-        # Fail quick if we don't have galleries, so we don't
-        # require PIL
-        Image = None
+        gallery_list = self.scan_galleries()
         if not gallery_list:
             yield {
                 'basename': 'render_galleries',
                 'actions': [],
                 }
             return
-        try:
-            import Image as _Image
-            Image = _Image
-        except ImportError:
-            try:
-                from PIL import Image as _Image
-                Image = _Image
-            except ImportError:
-                pass
-        if Image:
-            def create_thumb(src, dst):
-                size = kw["thumbnail_size"], kw["thumbnail_size"]
-                im = Image.open(src)
-                im.thumbnail(size, Image.ANTIALIAS)
-                im.save(dst)
-        else:
-            create_thumb = utils.copy_file
 
-        # gallery_path is "gallery/name"
-        for gallery_path in gallery_list:
-            # gallery_name is "name"
-            gallery_name = os.path.basename(gallery_path)
+        image_info = galleries.ImageInfoCache(kw["cache_folder"])
+        for gallery in gallery_list:
+            # gallery_path is "galleries/name"
+            gallery_path = gallery.path
+            # gallery_name is "name", or "parent/name" for galleries
+            # inside other galleries
+            gallery_name = gallery.name
             # output_gallery is "output/GALLERY_PATH/name"
             output_gallery = os.path.dirname(os.path.join(kw["output_folder"],
                 self.path("gallery", gallery_name, None)))
@@ -859,15 +1195,19 @@ class Nikola(object):
                     'clean': True,
                     'uptodate': [config_changed(kw)],
                     }
-            # image_list contains "gallery/name/image_name.jpg"
-            image_list = glob.glob(gallery_path + "/*jpg") +\
-                glob.glob(gallery_path + "/*JPG") +\
-                glob.glob(gallery_path + "/*PNG") +\
-                glob.glob(gallery_path + "/*png")
-            image_list = [x for x in image_list if "thumbnail" not in x]
+            # image_list contains "galleries/name/image_name.jpg"
+            image_list = list(gallery.images)
+            infos = dict((img, image_info.info(img)) for img in image_list)
+            if kw["sort_by_date"]:
+                # Images without a capture date go last
+                image_list.sort(key=lambda img: (infos[img]['date'] is None,
+                    infos[img]['date']))
             image_name_list = [os.path.basename(x) for x in image_list]
             thumbs = []
-            # Do thumbnails and copy originals
+            srcsets = []
+            metadata = []
+            image_jobs = []
+            # Copy originals
             for img, img_name in zip(image_list, image_name_list):
                 # img is "galleries/name/image_name.jpg"
                 # img_name is "image_name.jpg"
@@ -880,31 +1220,69 @@ class Nikola(object):
                 # thumb_path is "output/GALLERY_PATH/name/image_name.jpg"
                 orig_dest_path = os.path.join(output_gallery, img_name)
                 thumbs.append(os.path.basename(thumb_path))
+                outputs = [(thumb_path,
+                    (kw["thumbnail_size"], kw["thumbnail_size"]))]
+                info = dict(infos[img])
+                # Scaled copies are "output/GALLERY_PATH/name/image_name.w960.jpg"
+                srcset = []
+                srcset_widths = set()
+                for width in sorted(kw["image_widths"]):
+                    scaled_name = "%s.w%d%s" % (fname, width, ext)
+                    outputs.append((os.path.join(output_gallery, scaled_name),
+                        (width, None)))
+                    # Images are never scaled up, so copies of a narrow
+                    # image all have its own width; list that once.
+                    if info['width']:
+                        width = galleries.fit((info['width'],
+                            info['height']), (width, None))[0]
+                    if width not in srcset_widths:
+                        srcset_widths.add(width)
+                        srcset.append("%s %dw" % (scaled_name, width))
+                srcsets.append(", ".join(srcset))
+                if info['width']:
+                    info['thumbnail_width'], info['thumbnail_height'] = \
+                        galleries.fit((info['width'], info['height']),
+                            (kw["thumbnail_size"], kw["thumbnail_size"]))
+                else:
+                    info['thumbnail_width'] = info['thumbnail_height'] = None
+                metadata.append(info)
+                image_jobs.append((img, outputs))
                 yield {
                     'basename': 'render_galleries',
-                    'name': thumb_path,
+                    'name': orig_dest_path,
                     'file_dep': [img],
-                    'targets': [thumb_path, orig_dest_path],
-                    'actions': [
-                        (create_thumb, (img, thumb_path)),
-                        (utils.copy_file, (img, orig_dest_path))
-                    ],
+                    'targets': [orig_dest_path],
+                    'actions': [(utils.copy_file,
+                        (img, orig_dest_path, kw["copy_strategy"]))],
                     'clean': True,
                     'uptodate': [config_changed(kw)],
                 }
-            output_name = os.path.join(output_gallery, "index.html")
-            context = {}
-            context["lang"] = kw["default_lang"]
-            context["title"] = os.path.basename(gallery_path)
+            # Do all the thumbnails and scaled copies in one task, so
+            # they can be made in parallel.
+            yield {
+                'basename': 'render_galleries',
+                'name': os.path.join(output_gallery, '*.thumbnail'),
+                'file_dep': image_list,
+                'targets': [dst for _, outputs in image_jobs
+                    for dst, _ in outputs],
+                'actions': [(galleries.create_derivatives, (image_jobs,
+                    kw["cache_folder"], kw["thumbnail_processes"],
+                    kw["copy_strategy"]))],
+                'clean': True,
+                'uptodate': [config_changed(kw)],
+            }
             thumb_name_list = [os.path.basename(x) for x in thumbs]
-            context["images"] = zip(image_name_list, thumb_name_list)
-            context["permalink"] = self.link("gallery", gallery_name, None)
+            images = zip(image_name_list, thumb_name_list, srcsets, metadata)
+            # Galleries inside this one, as (title, link)
+            children = [(child.rsplit('/', 1)[-1],
+                self.link("gallery", child, None))
+                for child in gallery.children]
 
             # Use galleries/name/index.txt to generate a blurb for
             # the gallery, if it exists
-            index_path = os.path.join(gallery_path, "index.txt")
+            index_path = gallery.index_txt
             index_dst_path = os.path.join(gallery_path, "index.html")
-            if os.path.exists(index_path):
+            if index_path:
                 compile_html = self.get_compile_html(index_path)
                 yield {
                     'basename': 'render_galleries',
@@ -918,23 +1296,63 @@ class Nikola(object):
                 }
 
             def render_gallery(output_name, context, index_dst_path):
-                if os.path.exists(index_dst_path):
+                if index_dst_path and os.path.exists(index_dst_path):
                     with codecs.open(index_dst_path, "rb", "utf8") as fd:
                         context['text'] = fd.read()
                 else:
                     context['text'] = ''
                 self.render_template(template_name, output_name, context)
 
-            yield {
-                'basename': 'render_galleries',
-                'name': gallery_path,
-                'file_dep': self.template_deps(template_name) + image_list,
-                'targets': [output_name],
-                'actions': [(render_gallery,
-                    (output_name, context, index_dst_path))],
-                'clean': True,
-                'uptodate': [config_changed(kw)],
-            }
+            # Each page depends only on its own images, so adding
+            # images at the end only renders the last page again.
+            page_size = kw["page_size"] or len(images) or 1
+            pages = self.index_pages(zip(image_list, images), page_size) or \
+                [(0, [], None, None)]
+            gallery_link = self.link("gallery", gallery_name, None)
+            for i, page_images, prevlink, nextlink in pages:
+                page_name = self.index_page_name(i)
+                output_name = os.path.join(output_gallery, page_name)
+                context = {}
+                context["lang"] = kw["default_lang"]
+                context["title"] = os.path.basename(gallery_path)
+                context["images"] = [image for _, image in page_images]
+                context["permalink"] = gallery_link.rsplit('/', 1)[0] + \
+                    '/' + page_name
+                context["prevlink"] = prevlink
+                context["nextlink"] = nextlink
+                # The blurb and the galleries inside this one go on the
+                # first page
+                file_dep = self.template_deps(template_name) + \
+                    [img for img, _ in page_images]
+                self.sitemap_pages[output_name] = None
+                if i == 0:
+                    context["galleries"] = children
+                    page_text = index_dst_path
+                    if index_path:
+                        file_dep.append(index_dst_path)
+                else:
+                    context["galleries"] = []
+                    page_text = None
+                yield {
+                    'basename': 'render_galleries',
+                    'name': output_name,
+                    'file_dep': file_dep,
+                    'targets': [output_name],
+                    'actions': [(render_gallery,
+                        (output_name, context, page_text))],
+                    'clean': True,
+                    # One check only, see generic_post_list_renderer.
+                    # The images (names, srcset and sizes) are there so
+                    # removing one renders the page that showed it.
+                    'uptodate': [config_changed({
+                        'kw': kw,
+                        'images': context["images"],
+                        'galleries': context["galleries"],
+                        'prevlink': prevlink,
+                        'nextlink': nextlink,
+                    })],
+                }
+        image_info.save()
 
     @staticmethod
     def gen_task_redirect(**kw):
@@ -981,13 +1399,14 @@ class Nikola(object):
 
         output_folder
         files_folders
+        copy_strategy
         """
 
         flag = False
         for src in kw['files_folders']:
             dst = kw['output_folder']
 
-            for task in utils.copy_tree(src, dst):
+            for task in utils.copy_tree(src, dst, kw['copy_strategy']):
                 flag = True
                 task['basename'] = 'copy_files'
                 task['uptodate'] = task.get('uptodate', []) +\
@@ -999,6 +1418,138 @@ class Nikola(object):
                 'actions': (),
             }
 
+    @staticmethod
+    def gen_task_gzip(**kw):
+        """Write precompressed .gz siblings of text files in the output.
+
+        Each file gets its own task depending on the file, so only files
+        that changed are compressed again, and "doit -n" spreads the work
+        over several processes. Files smaller than gzip_min_size are
+        skipped.
+
+        Required keyword arguments:
+
+        output_files
+        output_folder
+        gzip_files
+        gzip_extensions
+        gzip_min_size
+        """
+        output_folder = os.path.join(kw['output_folder'], '')
+        flag = False
+        if kw['gzip_files']:
+            for path in kw['output_files']:
+                if not path.startswith(output_folder):
+                    continue
+                if not path.lower().endswith(tuple(kw['gzip_extensions'])):
+                    continue
+                flag = True
+                gz_path = path + '.gz'
+                # Files too small to compress make no .gz, and a missing
+                # target would make their task run in every build.
+                targets = [gz_path]
+                if (os.path.isfile(path) and
+                        os.path.getsize(path) < kw['gzip_min_size']):
+                    targets = []
+                yield {
+                    'basename': 'gzip',
+                    'name': gz_path.encode('utf8'),
+                    'file_dep': [path],
+                    'targets': targets,
+                    'actions': [(utils.gzip_file,
+                        (path, gz_path, kw['gzip_min_size']))],
+                    'clean': [(utils.remove_file, (gz_path,))],
+                    'uptodate': [config_changed(
+                        {'gzip_min_size': kw['gzip_min_size']})],
+                }
+        if not flag:
+            yield {
+                'basename': 'gzip',
+                'actions': (),
+            }
+
+    @staticmethod
+    def gen_task_prune_css(**kw):
+        """Write stylesheets without the rules no page uses.
+
+        Runs after every HTML page in the output is rendered, but only
+        pages that changed since the last run are parsed again.
+
+        Required keyword arguments:
+
+        stylesheets
+        output_files
+        output_folder
+        allowlist
+        cache_folder
+        """
+        if not kw['stylesheets']:
+            yield {
+                'basename': 'prune_css',
+                'actions': (),
+            }
+            return
+        output_prefix = os.path.join(kw['output_folder'], '')
+        pages = sorted(path for path in kw['output_files']
+            if path.startswith(output_prefix) and path.endswith('.html'))
+        yield {
+            'basename': 'prune_css',
+            'name': 'stylesheets',
+            'file_dep': pages + [src for src, _ in kw['stylesheets']],
+            'targets': [dst for _, dst in kw['stylesheets']],
+            'actions': [(cssprune.prune_stylesheets, (pages,
+                kw['stylesheets'], kw['allowlist'], kw['cache_folder']))],
+            'verbosity': 2,
+            'clean': True,
+            'uptodate': [config_changed({
+                'stylesheets': kw['stylesheets'],
+                'allowlist': kw['allowlist'],
+            })],
+        }
+
+    @staticmethod
+    def gen_task_bundles(**kw):
+        """Write asset bundles and their manifest.
+
+        A bundle is only built again when one of its files changes,
+        and then it gets a new name.
+
+        Required keyword arguments:
+
+        bundles
+        manifest_path
+        output_folder
+        """
+        if not kw['bundles']:
+            yield {
+                'basename': 'bundles',
+                'actions': (),
+            }
+            return
+        manifest = {}
+        for name, (hashed, sources) in sorted(kw['bundles'].items()):
+            manifest[name] = hashed
+            output_name = os.path.join(kw['output_folder'],
+                *hashed.split('/'))
+            yield {
+                'basename': 'bundles',
+                'name': output_name,
+                'file_dep': sources,
+                'targets': [output_name],
+                'actions': [(assets.build_bundle, (sources, output_name))],
+                'clean': True,
+                'uptodate': [config_changed({'sources': sources})],
+            }
+        yield {
+            'basename': 'bundles',
+            'name': kw['manifest_path'],
+            'targets': [kw['manifest_path']],
+            'actions': [(assets.write_manifest,
+                (manifest, kw['manifest_path']))],
+            'clean': True,
+            'uptodate': [config_changed(manifest)],
+        }
+
     @staticmethod
     def gen_task_copy_assets(**kw):
         """Create tasks to copy the assets of the whole theme chain.
@@ -1010,13 +1561,14 @@ class Nikola(object):
 
         themes
         output_folder
+        copy_strategy
 
         """
         tasks = {}
         for theme_name in kw['themes']:
             src = os.path.join(utils.get_theme_path(theme_name), 'assets')
             dst = os.path.join(kw['output_folder'], 'assets')
-            for task in utils.copy_tree(src, dst):
+            for task in utils.copy_tree(src, dst, kw['copy_strategy']):
                 if task['name'] in tasks:
                     continue
                 tasks[task['name']] = task
@@ -1097,82 +1649,94 @@ class Nikola(object):
     def gen_task_sitemap(**kw):
         """Generate Google sitemap.
 
+        The pages come from the renderers, so the output folder is not
+        walked.
+
+        Pages are split in shards (sitemap-section.xml.gz), each one a
+        task that runs only when its pages or their dates change, and
+        sitemap.xml.gz is an index of the shards.
+
+        If lastmod is "date", pages are dated by their posts, and
+        rendering doesn't have to finish first. If it's "content", the
+        date is when the rendered page last changed, as recorded in
+        cache_folder.
+
         Required keyword arguments:
 
         blog_url
         output_folder
+        pages
+        lastmod
+        cache_folder
         """
-
-        output_path = os.path.abspath(kw['output_folder'])
-        sitemap_path = os.path.join(output_path, "sitemap.xml.gz")
-
-        def sitemap():
-            # Generate config
-            config_data = """<?xml version="1.0" encoding="UTF-8"?>
-    <site
-    base_url="%s"
-    store_into="%s"
-    verbose="1" >
-    <directory path="%s" url="%s" />
-    <filter action="drop" type="wildcard" pattern="*~" />
-    <filter action="drop" type="regexp" pattern="/\.[^/]*" />
-    </site>""" % (
-                kw["blog_url"],
-                sitemap_path,
-                output_path,
-                kw["blog_url"],
-            )
-            config_file = tempfile.NamedTemporaryFile(delete=False)
-            config_file.write(config_data)
-            config_file.close()
-
-            # Generate sitemap
-            import sitemap_gen as smap
-            sitemap = smap.CreateSitemapFromFile(config_file.name, True)
-            if not sitemap:
-                smap.output.Log('Configuration file errors -- exiting.', 0)
+        index_path = os.path.join(kw['output_folder'], "sitemap.xml.gz")
+        by_content = kw['lastmod'] == 'content'
+        entries = []
+        for path, date in kw['pages'].items():
+            url = sitemaps.page_url(kw['blog_url'], kw['output_folder'], path)
+            if by_content:
+                entries.append((url, path))
             else:
-                sitemap.Generate()
-                smap.output.Log('Number of errors: %d' %
-                    smap.output.num_errors, 1)
-                smap.output.Log('Number of warnings: %d' %
-                    smap.output.num_warns, 1)
-            os.unlink(config_file.name)
+                entries.append((url, sitemaps.w3c_date(date)))
+        shards = sitemaps.shard_entries(entries, kw['blog_url'])
+        index = []
+        for name, shard in sorted(shards.items()):
+            file_name = "sitemap-%s.xml.gz" % name
+            shard_path = os.path.join(kw['output_folder'], file_name)
+            shard_url = kw['blog_url'].rstrip('/') + '/' + file_name
+            task = {
+                "basename": "sitemap",
+                "name": shard_path.encode('utf8'),
+                "targets": [shard_path],
+                "clean": True,
+                }
+            if by_content:
+                store_path = os.path.join(kw['cache_folder'], 'sitemap',
+                    name + '.json')
+                index.append((shard_url, store_path))
+                task["file_dep"] = [path for _, path in shard]
+                task["actions"] = [(sitemaps.write_content_sitemap,
+                    (shard, shard_path, store_path))]
+                task["uptodate"] = [config_changed({'pages': shard})]
+            else:
+                index.append((shard_url,
+                    max([lastmod for _, lastmod in shard] or [None])))
+                task["actions"] = [(sitemaps.write_sitemap,
+                    (shard, shard_path))]
+                task["uptodate"] = [config_changed({'entries': shard})]
+            yield task
 
-        yield {
+        stale_pattern = os.path.join(kw['output_folder'], "sitemap-*.xml.gz")
+        task = {
             "basename": "sitemap",
-            "task_dep": [
-                "render_archive",
-                "render_indexes",
-                "render_pages",
-                "render_posts",
-                "render_rss",
-                "render_sources",
-                "render_tags"],
-            "targets": [sitemap_path],
-            "actions": [(sitemap,)],
-            "uptodate": [config_changed(kw)],
+            "name": index_path,
+            "targets": [index_path],
+            "uptodate": [config_changed({'shards': index})],
             "clean": True,
             }
-
+        if by_content:
+            # Shard dates are known only after the shards are written
+            task["file_dep"] = [os.path.join(kw['output_folder'],
+                os.path.basename(url)) for url, _ in index]
+            task["actions"] = [(sitemaps.write_content_sitemap_index,
+                (index, index_path, stale_pattern))]
+        else:
+            task["actions"] = [(sitemaps.write_sitemap_index,
+                (index, index_path, stale_pattern))]
+        yield task
 
     @staticmethod
     def task_serve(**kw):
         """
-        Start test server. (Usage: doit serve [--address 127.0.0.1] [--port 8000])
-        By default, the server runs on port 8000 on the IP address 127.0.0.1.
+        Start test server. (Usage: doit serve [--address 127.0.0.1] [--port 8000] [--workers 8] [--cache 32])
+        By default, the server runs on port 8000 on the IP address 127.0.0.1,
+        with 8 worker threads and up to 32MB of files cached in memory.
         """
 
-        def serve(address, port):
-            from BaseHTTPServer import HTTPServer
-            from SimpleHTTPServer import SimpleHTTPRequestHandler as handler
-
-            os.chdir(kw['output_folder'])
-
-            httpd = HTTPServer((address, port), handler)
-            sa = httpd.socket.getsockname()
-            print "Serving HTTP on", sa[0], "port", sa[1], "..."
-            httpd.serve_forever()
+        def serve(address, port, workers, cache):
+            import server
+            server.serve(kw['output_folder'], address, port, workers,
+                cache << 20)
 
         yield {
             "basename": 'serve',
@@ -1189,7 +1753,19 @@ class Nikola(object):
                         'long': 'port',
                         'type': int,
                         'default': 8000,
-                        'help': 'Port number (default: 8000)'}],
+                        'help': 'Port number (default: 8000)'},
+                       {'short': 'w',
+                        'name': 'workers',
+                        'long': 'workers',
+                        'type': int,
+                        'default': 8,
+                        'help': 'Threads handling requests (default: 8)'},
+                       {'short': 'c',
+                        'name': 'cache',
+                        'long': 'cache',
+                        'type': int,
+                        'default': 32,
+                        'help': 'MB of files cached in memory (default: 32)'}],
             }
 
     @staticmethod
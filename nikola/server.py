@@ -0,0 +1,242 @@
+"""A development server for the output folder.
+
+Requests are handled by a fixed number of worker threads, so one slow
+client doesn't block the others and load can't start unlimited threads.
+
+Files are served with ETag and Last-Modified headers, and conditional
+requests get "304 Not Modified". When the client accepts gzip and the
+file has an up to date ".gz" sibling (see GZIP_FILES), that one is sent
+instead. Small files are kept in memory, in a cache of limited size that
+drops the least recently used ones first.
+"""
+
+from BaseHTTPServer import HTTPServer
+from email.utils import parsedate_tz, mktime_tz
+import os
+import posixpath
+import Queue
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from StringIO import StringIO
+import threading
+import urllib
+
+__all__ = ['FileCache', 'DevRequestHandler', 'WorkerPoolHTTPServer', 'serve']
+
+
+class FileCache(object):
+    """Contents of files, by path, up to max_bytes in total.
+
+    Entries are checked against the file's mtime and size, and the least
+    recently used are dropped when there's no room. Files bigger than
+    max_file_bytes are never cached. Safe to use from several threads.
+    """
+
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+        # path: [(mtime, size), data, when it was last used]
+        self._entries = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, stat):
+        """Return the contents of path, or None if they are not cached.
+
+        stat is the file's current os.stat result.
+        """
+        key = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return None
+            if entry[0] != key:
+                del self._entries[path]
+                self.size -= len(entry[1])
+                return None
+            self._clock += 1
+            entry[2] = self._clock
+            return entry[1]
+
+    def put(self, path, stat, data):
+        """Remember data as the contents of path, if it fits."""
+        if len(data) > self.max_file_bytes or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[1])
+            while self._entries and self.size + len(data) > self.max_bytes:
+                oldest = min(self._entries,
+                    key=lambda p: self._entries[p][2])
+                self.size -= len(self._entries.pop(oldest)[1])
+            self._clock += 1
+            self._entries[path] = [(stat.st_mtime, stat.st_size), data,
+                self._clock]
+            self.size += len(data)
+
+
+class DevRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files from server.root, with caching headers and gzip."""
+
+    def translate_path(self, path):
+        # Like SimpleHTTPRequestHandler, but relative to the server's root
+        # instead of the current folder, which other threads may change.
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        trailing_slash = path.rstrip().endswith('/')
+        path = posixpath.normpath(urllib.unquote(path))
+        result = self.server.root
+        for word in path.split('/'):
+            if not word or word in (os.curdir, os.pardir):
+                continue
+            result = os.path.join(result, word)
+        if trailing_slash:
+            result += '/'
+        return result
+
+    def _etag(self, stat, encoding):
+        return '"%x-%x%s"' % (int(stat.st_mtime), stat.st_size,
+            '-gzip' if encoding else '')
+
+    def _not_modified(self, etag, mtime):
+        """True if the client's copy, as described in the request, is
+        current."""
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+        if_modified_since = self.headers.getheader('If-Modified-Since')
+        if if_modified_since:
+            date = parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(mtime) <= mktime_tz(date)
+        return False
+
+    def _accepts_gzip(self):
+        for coding in (self.headers.getheader('Accept-Encoding') or
+                '').split(','):
+            parts = coding.split(';')
+            if parts[0].strip().lower() not in ('gzip', 'x-gzip'):
+                continue
+            for param in parts[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            for index in "index.html", "index.htm":
+                if os.path.isfile(os.path.join(path, index)):
+                    break
+            else:
+                # Redirects and directory listings, as usual
+                return SimpleHTTPRequestHandler.send_head(self)
+            if not self.path.split('?', 1)[0].endswith('/'):
+                return SimpleHTTPRequestHandler.send_head(self)
+            path = os.path.join(path, index)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        ctype = self.guess_type(path)
+
+        encoding = None
+        if self._accepts_gzip():
+            try:
+                gz_stat = os.stat(path + '.gz')
+                if gz_stat.st_mtime >= stat.st_mtime:
+                    path, stat, encoding = path + '.gz', gz_stat, 'gzip'
+            except OSError:
+                pass
+
+        etag = self._etag(stat, encoding)
+        if self._not_modified(etag, stat.st_mtime):
+            self.send_response(304)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified",
+                self.date_time_string(stat.st_mtime))
+            self.end_headers()
+            return None
+
+        data = self.server.cache.get(path, stat)
+        if data is None:
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                self.send_error(404, "File not found")
+                return None
+            # The file may have changed since it was checked, so describe
+            # what was actually opened.
+            stat = os.fstat(f.fileno())
+            etag = self._etag(stat, encoding)
+            if stat.st_size <= self.server.cache.max_file_bytes:
+                data = f.read()
+                f.close()
+                self.server.cache.put(path, stat, data)
+        if data is not None:
+            f = StringIO(data)
+            length = len(data)
+        else:
+            length = stat.st_size
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Last-Modified", self.date_time_string(stat.st_mtime))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return f
+
+
+class WorkerPoolHTTPServer(HTTPServer):
+    """An HTTPServer that handles requests in a fixed pool of threads.
+
+    Accepted connections wait in a queue of limited size when all the
+    workers are busy.
+    """
+
+    def __init__(self, server_address, handler_class, root, workers=8,
+            cache=None):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.root = root
+        self.cache = cache or FileCache(32 << 20, 1 << 20)
+        self._requests = Queue.Queue(4 * workers)
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        # shutdown_request is new in Python 2.7
+        shutdown_request = getattr(self, 'shutdown_request',
+            self.close_request)
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+
+def serve(root, address, port, workers=8, cache_bytes=32 << 20):
+    """Serve the root folder until interrupted."""
+    httpd = WorkerPoolHTTPServer((address, port), DevRequestHandler, root,
+        workers, FileCache(cache_bytes, min(1 << 20, cache_bytes)))
+    sa = httpd.socket.getsockname()
+    print "Serving HTTP on", sa[0], "port", sa[1], "..."
+    httpd.serve_forever()
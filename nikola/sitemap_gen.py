@@ -50,6 +50,11 @@ Usage: python sitemap_gen.py --config=config.xml [--help] [--testing]
             --testing, specified when user is experimenting
 """
 
+# It can also be used as a library: GenerateSitemap(configpath) runs with
+# its own state (messages, error counts, learned encodings) and returns
+# statistics, so it can be called many times, or from several threads at
+# once, in the same process.
+
 # Please be careful that all syntax used in this file can be parsed on
 # Python 1.5 -- this version check is not evaluated until after the
 # entire file has been parsed.
@@ -59,18 +64,26 @@ if sys.hexversion < 0x02020000:
   print 'Currently run with version: %s' % sys.version
   sys.exit(1)
 
+import array
+import cStringIO
 import fnmatch
 import glob
 import gzip
 import hashlib
+import multiprocessing
 import os
+import Queue
 import re
 import stat
+import struct
+import threading
 import time
 import types
 import urllib
 import urlparse
 import xml.sax
+import xml.sax.saxutils
+from xml.etree import cElementTree
 
 # True and False were introduced in Python2.2.2
 try:
@@ -95,11 +108,26 @@ MAXURLS_PER_SITEMAP = 50000
 # Suffix on a Sitemap index file
 SITEINDEX_SUFFIX = '_index.xml'
 
-# Regular expressions tried for extracting URLs from access logs.
-ACCESSLOG_CLF_PATTERN = re.compile(
-  r'.+\s+"([^\s]+)\s+([^\s]+)\s+HTTP/\d+\.\d+"\s+200\s+.*'
+# Regular expression for extracting the URLs of successful GET and HEAD
+# requests from a block of access log lines (Common Logfile Format).
+ACCESSLOG_CLF_BLOCK_PATTERN = re.compile(
+  r'^[^\n"]*"(?:GET|HEAD)[ \t]+([^\s"]+)[ \t]+HTTP/\d+\.\d+"[ \t]+200[ \t]',
+  re.MULTILINE
   )
 
+# Back references (plain, named or in a conditional) and flags in a regular
+# expression, which make it impossible to combine with others.
+FILTER_NOT_COMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)')
+
+# Python's re module doesn't support more than 100 groups in an expression.
+FILTER_MAX_GROUPS = 99
+
+# Default compression level of gzipped Sitemap files
+DEFAULT_COMPRESSION_LEVEL = 9
+
+# Bytes read from access logs at a time
+ACCESSLOG_BLOCK_SIZE = 4 * 1024 * 1024
+
 # Match patterns for lastmod attributes
 LASTMOD_PATTERNS = map(re.compile, [
   r'^\d\d\d\d$',
@@ -177,6 +205,12 @@ class SchemaError(Error):
 #end class SchemeError
 
 
+class FatalError(Error):
+  """Failure that stops the whole run, raised by Output.Fatal."""
+  pass
+#end class FatalError
+
+
 class Encoder:
   """
   Manages wide-character/narrow-character conversions for just about all
@@ -350,7 +384,6 @@ class Encoder:
     return text.decode(ENC_ASCII, 'ignore')
   #end def WidenText
 #end class Encoder
-encoder = Encoder()
 
 
 class Output:
@@ -412,13 +445,13 @@ class Output:
   #end def Error
 
   def Fatal(self, text):
-    """ Output an error and terminate the program. """
+    """ Output an error and stop the run by raising FatalError. """
     if text:
       text = encoder.NarrowText(text, None)
       print '[FATAL] ' + text
     else:
       print 'Fatal error.'
-    sys.exit(1)
+    raise FatalError(text)
   #end def Fatal
 
   def SetVerbose(self, level):
@@ -434,7 +467,66 @@ class Output:
     self.Error('Verbose level (%s) must be between 0 and 3 inclusive.' % level)
   #end def SetVerbose
 #end class Output
-output = Output()
+
+
+class RunState:
+  """
+  Everything a sitemap generation run changes as it goes: its Output
+  (verbosity, error and warning counts) and its Encoder (user and learned
+  encodings).
+
+  The module-level "output" and "encoder" stand for the state of the run
+  active in the current thread (see Activate), or for a default state
+  when no run is active, as when used from the command line.
+  """
+
+  def __init__(self):
+    self.output  = Output()
+    self.encoder = Encoder()
+  #end def __init__
+
+  def Activate(self):
+    """ Makes this the state of the run in the current thread """
+    stack = getattr(_active_runs, 'stack', None)
+    if stack is None:
+      stack = _active_runs.stack = []
+    stack.append(self)
+  #end def Activate
+
+  def Deactivate(self):
+    """ Goes back to the state that was active before Activate """
+    assert _active_runs.stack[-1] is self
+    _active_runs.stack.pop()
+  #end def Deactivate
+#end class RunState
+
+
+def CurrentRunState():
+  """ Returns the RunState active in the current thread """
+  stack = getattr(_active_runs, 'stack', None)
+  if stack:
+    return stack[-1]
+  return _default_run
+#end def CurrentRunState
+
+
+class _RunStateProxy:
+  """ Forwards to one of the objects of the current RunState """
+
+  def __init__(self, name):
+    self._name = name
+  #end def __init__
+
+  def __getattr__(self, attribute):
+    return getattr(getattr(CurrentRunState(), self._name), attribute)
+  #end def __getattr__
+#end class _RunStateProxy
+
+
+_active_runs = threading.local()
+_default_run = RunState()
+output       = _RunStateProxy('output')
+encoder      = _RunStateProxy('encoder')
 
 
 class URL(object):
@@ -644,6 +736,89 @@ class URL(object):
 #end class URL
 
 
+class URLCounter:
+  """
+  Maps URL hashes (from URL.MakeHash) to a count, like a dictionary but
+  in a fraction of the memory, for sites with millions of URLs.
+
+  Only the first 8 bytes of each hash are kept, in an open addressing
+  hash table made of arrays: 12 bytes per slot instead of a string, an
+  integer and a dictionary entry per URL. Counts must not be 0, which
+  marks an empty slot.
+  """
+
+  def __init__(self, capacity=1024):
+    self._size = 0
+    self._Allocate(capacity)
+  #end def __init__
+
+  def _Allocate(self, capacity):
+    """ Makes empty arrays for capacity slots, a power of 2 """
+    slots = 8
+    while slots < capacity:
+      slots = slots * 2
+    self._mask   = slots - 1
+    self._high   = array.array('I', [0]) * slots
+    self._low    = array.array('I', [0]) * slots
+    self._counts = array.array('i', [0]) * slots
+  #end def _Allocate
+
+  def _Find(self, high, low):
+    """ Returns the slot for a key: where it is, or where it would go """
+    mask   = self._mask
+    counts = self._counts
+    slot   = low & mask
+    while counts[slot] and (self._low[slot] != low or
+                            self._high[slot] != high):
+      slot = (slot + 1) & mask
+    return slot
+  #end def _Find
+
+  def _Grow(self):
+    """ Doubles the number of slots """
+    high, low, counts = self._high, self._low, self._counts
+    self._Allocate(2 * len(counts))
+    for slot in xrange(len(counts)):
+      if counts[slot]:
+        new_slot = self._Find(high[slot], low[slot])
+        self._high[new_slot]   = high[slot]
+        self._low[new_slot]    = low[slot]
+        self._counts[new_slot] = counts[slot]
+  #end def _Grow
+
+  def __len__(self):
+    return self._size
+  #end def __len__
+
+  def __contains__(self, hash):
+    high, low = struct.unpack('<II', hash[:8])
+    return self._counts[self._Find(high, low)] != 0
+  #end def __contains__
+
+  def __getitem__(self, hash):
+    high, low = struct.unpack('<II', hash[:8])
+    count = self._counts[self._Find(high, low)]
+    if not count:
+      raise KeyError(hash)
+    return count
+  #end def __getitem__
+
+  def __setitem__(self, hash, count):
+    high, low = struct.unpack('<II', hash[:8])
+    slot = self._Find(high, low)
+    if not self._counts[slot]:
+      # Keep at most 2/3 of the slots used, so probes stay short
+      if 3 * (self._size + 1) > 2 * len(self._counts):
+        self._Grow()
+        slot = self._Find(high, low)
+      self._high[slot] = high
+      self._low[slot]  = low
+      self._size = self._size + 1
+    self._counts[slot] = count
+  #end def __setitem__
+#end class URLCounter
+
+
 class Filter:
   """
   A filter on the stream of URLs we find.  A filter is, in essence,
@@ -723,9 +898,85 @@ class Filter:
 
     assert False # unreachable
   #end def Apply
+
+  def Pattern(self):
+    """
+    Returns a regular expression that matches from the start of a URL
+    whenever this filter applies to it, for FilterSet, or None if the
+    pattern can't be combined with others (it has named groups, back
+    references, conditionals or flags).
+    """
+    if self._wildcard:
+      return r'(?:%s)\Z' % WildcardToRegexp(self._wildcard)
+    if self._regexp:
+      pattern = self._regexp.pattern
+      if self._regexp.groupindex or FILTER_NOT_COMBINABLE.search(pattern):
+        return None
+      # Lazily skipping ahead makes a match from the start act as search()
+      return r'[\s\S]*?(?:%s)' % pattern
+    return None
+  #end def Pattern
 #end class Filter
 
 
+class FilterSet:
+  """
+  The filters of a Sitemap, compiled so that a URL is matched against
+  all of them at once, with the same result as trying them one by one.
+
+  Filters are combined into as few regular expressions as possible, one
+  alternative (a named group) per filter. At a given position the
+  alternatives are tried in order, and all of them start matching at the
+  beginning of the URL, so the first filter that applies wins.
+  """
+
+  def __init__(self, filters):
+    self._steps = []                        # (regexp, group actions) or Filter
+
+    alternatives = []
+    actions      = {}
+    groups       = 0
+    for filter in filters:
+      pattern = filter.Pattern()
+      if pattern is None:
+        self._AddStep(alternatives, actions)
+        alternatives, actions, groups = [], {}, 0
+        self._steps.append(filter)
+        continue
+      size = re.compile(pattern).groups + 1
+      if groups + size > FILTER_MAX_GROUPS:
+        self._AddStep(alternatives, actions)
+        alternatives, actions, groups = [], {}, 0
+      name = 'filter%d' % len(alternatives)
+      alternatives.append('(?P<%s>%s)' % (name, pattern))
+      actions[name] = filter._pass
+      groups = groups + size
+    self._AddStep(alternatives, actions)
+  #end def __init__
+
+  def _AddStep(self, alternatives, actions):
+    if alternatives:
+      self._steps.append((re.compile('|'.join(alternatives)), actions))
+  #end def _AddStep
+
+  def Apply(self, url):
+    """ Returns what the first filter that applies does, see Filter """
+    if (not url) or (not url.loc):
+      return None
+    for step in self._steps:
+      if isinstance(step, Filter):
+        accept = step.Apply(url)
+        if accept != None:
+          return accept
+        continue
+      match = step[0].match(url.loc)
+      if match:
+        return step[1][match.lastgroup]
+    return None
+  #end def Apply
+#end class FilterSet
+
+
 class InputURL:
   """
   Each Input class knows how to yield a set of URLs from a data source.
@@ -1016,47 +1267,36 @@ class InputDirectory:
 #end class InputDirectory
 
 
-class InputAccessLog:
+class AccessLogScanner:
   """
-  Each Input class knows how to yield a set of URLs from a data source.
-
-  This one handles access logs.  It's non-trivial in that we want to
-  auto-detect log files in the Common Logfile Format (as used by Apache,
-  for instance) and the Extended Log File Format (as used by IIS, for
-  instance).
+  Counts the successful GET and HEAD requests for each URL in an access
+  log, in the Common Logfile Format (as used by Apache, for instance) or
+  the Extended Log File Format (as used by IIS, for instance).
+
+  Logs are read in large blocks, gzipped ones as a stream, and are never
+  decoded: URLs are returned as found in the file. CLF blocks are matched
+  with a single regular expression, ELF lines are skipped by a cheap
+  check for "200" before they are split.
   """
 
-  def __init__(self, attributes):
-    self._path         = None               # The file path
-    self._encoding     = None               # Encoding of that file
+  def __init__(self):
     self._is_elf       = False              # Extended Log File Format?
-    self._is_clf       = False              # Common Logfile Format?
     self._elf_status   = -1                 # ELF field: '200'
     self._elf_method   = -1                 # ELF field: 'HEAD'
     self._elf_uri      = -1                 # ELF field: '/foo?bar=1'
     self._elf_urifrag1 = -1                 # ELF field: '/foo'
     self._elf_urifrag2 = -1                 # ELF field: 'bar=1'
-
-    if not ValidateAttributes('ACCESSLOG', attributes, ('path', 'encoding')):
-      return
-
-    self._path      = attributes.get('path')
-    self._encoding  = attributes.get('encoding', ENC_UTF8)
-    if self._path:
-      self._path    = encoder.MaybeNarrowPath(self._path)
-      if os.path.isfile(self._path):
-        output.Log('Input: From ACCESSLOG "%s"' % self._path, 2)
-      else:
-        output.Error('Can not locate file: %s' % self._path)
-        self._path = None
-    else:
-      output.Error('Accesslog entries must have a "path" attribute.')
   #end def __init__
 
   def RecognizeELFLine(self, line):
     """ Recognize the Fields directive that heads an ELF file """
     if not line.startswith('#Fields:'):
       return False
+    self._elf_status   = -1
+    self._elf_method   = -1
+    self._elf_uri      = -1
+    self._elf_urifrag1 = -1
+    self._elf_urifrag2 = -1
     fields = line.split(' ')
     del fields[0]
     for i in range(0, len(fields)):
@@ -1071,7 +1311,6 @@ class InputAccessLog:
         self._elf_urifrag1 = i
       elif field == 'cs-uri-query':
         self._elf_urifrag2 = i
-    output.Log('Recognized an Extended Log File Format file.', 2)
     return True
   #end def RecognizeELFLine
 
@@ -1118,62 +1357,155 @@ class InputAccessLog:
     return None
   #end def GetELFLine
 
-  def RecognizeCLFLine(self, line):
-    """ Try to tokenize a logfile line according to CLF pattern and see if
-    it works. """
-    match = ACCESSLOG_CLF_PATTERN.match(line)
-    recognize = match and (match.group(1) in ('HEAD', 'GET'))
-    if recognize:
-      output.Log('Recognized a Common Logfile Format file.', 2)
-    return recognize
-  #end def RecognizeCLFLine
-
-  def GetCLFLine(self, line):
-    """ Fetch the requested URL from a CLF line """
-    match = ACCESSLOG_CLF_PATTERN.match(line)
-    if match:
-      request = match.group(1)
-      if request in ('HEAD', 'GET'):
-        return match.group(2)
-    return None
-  #end def GetCLFLine
+  def ScanELFBlock(self, block, hits):
+    """ Count the URLs in a block of whole ELF lines """
+    for line in block.split('\n'):
+      if line.startswith('#'):
+        if self.RecognizeELFLine(line.rstrip()):
+          self._is_elf = True
+        continue
+      if not self._is_elf:
+        continue
+      if self._elf_status >= 0 and line.find('200') < 0:
+        continue
+      url = self.GetELFLine(line.rstrip())
+      if url:
+        hits[url] = hits.get(url, 0) + 1
+  #end def ScanELFBlock
+
+  def ScanCLFBlock(self, block, hits):
+    """ Count the URLs in a block of whole CLF lines """
+    for url in ACCESSLOG_CLF_BLOCK_PATTERN.findall(block):
+      hits[url] = hits.get(url, 0) + 1
+  #end def ScanCLFBlock
+
+  def Scan(self, path):
+    """
+    Returns a dictionary of URL (as found in the log) to number of hits,
+    or None if the file can't be read.
+    """
+    try:
+      if path.endswith('.gz'):
+        file = gzip.GzipFile(path, 'rb')
+      else:
+        file = open(path, 'rb')
+    except IOError:
+      return None
 
-  def ProduceURLs(self, consumer):
-    """ Produces URLs from our data source, hands them in to the consumer. """
+    hits = {}
+    tail = ''
+    try:
+      while True:
+        data = file.read(ACCESSLOG_BLOCK_SIZE)
+        if data:
+          # Only whole lines, the rest waits for the next block
+          cut = data.rfind('\n') + 1
+          if not cut:
+            tail = tail + data
+            continue
+          block = tail + data[:cut]
+          tail = data[cut:]
+        else:
+          block = tail
+        if not self._is_elf and (block.startswith('#') or
+                                 block.find('\n#Fields:') >= 0):
+          self._is_elf = True
+        if self._is_elf:
+          self.ScanELFBlock(block, hits)
+        else:
+          self.ScanCLFBlock(block, hits)
+        if not data:
+          break
+    finally:
+      file.close()
+    return hits
+  #end def Scan
+#end class AccessLogScanner
 
-    # Open the file
-    (frame, file) = OpenFileForRead(self._path, 'ACCESSLOG')
-    if not file:
+
+def ScanAccessLog(path):
+  """ Runs an AccessLogScanner, in a worker process if needed """
+  return (path, AccessLogScanner().Scan(path))
+#end def ScanAccessLog
+
+
+class InputAccessLog:
+  """
+  Each Input class knows how to yield a set of URLs from a data source.
+
+  This one handles access logs, see AccessLogScanner. The path can be a
+  glob pattern, to read rotated logs ("access.log*"); when it matches
+  several files they are scanned by a pool of processes ("processes"
+  attribute, by default one per CPU).
+
+  Each URL is produced once, with a priority from its share of the hits:
+  the most requested URL gets 1.0.
+  """
+
+  def __init__(self, attributes):
+    self._paths        = []                 # The file paths
+    self._encoding     = None               # Encoding of those files
+    self._processes    = None               # Number of worker processes
+
+    if not ValidateAttributes('ACCESSLOG', attributes,
+                              ('path', 'encoding', 'processes')):
       return
 
-    # Iterate lines
-    for line in file.readlines():
-      if self._encoding:
-        line = encoder.WidenText(line, self._encoding)
-      line = line.strip()
+    path            = attributes.get('path')
+    self._encoding  = attributes.get('encoding', ENC_UTF8)
+    if attributes.get('processes'):
+      try:
+        self._processes = int(attributes.get('processes'))
+      except ValueError:
+        output.Error('Accesslog "processes" must be a number.')
+    if path:
+      path          = encoder.MaybeNarrowPath(path)
+      self._paths   = sorted(filter(os.path.isfile, glob.glob(path)))
+      if self._paths:
+        output.Log('Input: From ACCESSLOG "%s" (%d files)' %
+                   (path, len(self._paths)), 2)
+      else:
+        output.Error('Can not locate file: %s' % path)
+    else:
+      output.Error('Accesslog entries must have a "path" attribute.')
+  #end def __init__
 
-      # If we don't know the format yet, try them both
-      if (not self._is_clf) and (not self._is_elf):
-        self._is_elf = self.RecognizeELFLine(line)
-        self._is_clf = self.RecognizeCLFLine(line)
-
-      # Digest the line
-      match = None
-      if self._is_elf:
-        match = self.GetELFLine(line)
-      elif self._is_clf:
-        match = self.GetCLFLine(line)
-      if not match:
+  def ProduceURLs(self, consumer):
+    """ Produces URLs from our data source, hands them in to the consumer. """
+    if not self._paths:
+      return
+
+    if self._processes == 1 or len(self._paths) < 2:
+      results = map(ScanAccessLog, self._paths)
+    else:
+      pool = multiprocessing.Pool(self._processes)
+      try:
+        results = pool.map(ScanAccessLog, self._paths)
+      finally:
+        pool.close()
+        pool.join()
+
+    # Add up the hits from every file
+    hits = {}
+    for (path, file_hits) in results:
+      if file_hits is None:
+        output.Error('Can not open file: %s' % path)
         continue
+      output.Log('Read %d URLs from ACCESSLOG file: %s' %
+                 (len(file_hits), path), 1)
+      for (loc, count) in file_hits.iteritems():
+        hits[loc] = hits.get(loc, 0) + count
+    if not hits:
+      return
+    max_hits = float(max(hits.itervalues()))
 
-      # Pass it on
+    for (loc, count) in hits.iteritems():
       url = URL()
-      url.TrySetAttribute('loc', match)
+      if self._encoding:
+        loc = encoder.WidenText(loc, self._encoding)
+      url.TrySetAttribute('loc', loc)
+      url.TrySetAttribute('priority', '%.4f' % (count / max_hits))
       consumer(url, True)
-
-    file.close()
-    if frame:
-      frame.close()
   #end def ProduceURLs
 #end class InputAccessLog
 
@@ -1388,7 +1720,7 @@ class InputSitemap(xml.sax.handler.ContentHandler):
     self._contexts_idx  = None              # ...contexts for index files
     self._contexts_stm  = None              # ...contexts for Sitemap files
 
-    if not ValidateAttributes('SITEMAP', attributes, ['path']):
+    if not ValidateAttributes('SITEMAP', attributes, ['path', 'streaming']):
       return
 
     # Init the first file path
@@ -1470,33 +1802,10 @@ class InputSitemap(xml.sax.handler.ContentHandler):
 
   def _MungeLocationListIntoFiles(self, urllist):
     """Given a list of URLs, munge them into our self._pathlist property.
-    We do this by assuming all the files live in the same directory as
-    the first file in the existing pathlist.  That is, we assume a
-    Sitemap index points to Sitemaps only in the same directory.  This
-    is not true in general, but will be true for any output produced
-    by this script.
+    See SitemapIndexFiles.
     """
     assert self._pathlist
-    path = self._pathlist[0]
-    path = os.path.normpath(path)
-    dir  = os.path.dirname(path)
-    wide = False
-    if type(path) == types.UnicodeType:
-      wide = True
-
-    for url in urllist:
-      url = URL.Canonicalize(url)
-      output.Log('Index points to Sitemap file at: %s' % url, 2)
-      (scheme, netloc, path, query, frag) = urlparse.urlsplit(url)
-      file = os.path.basename(path)
-      file = urllib.unquote(file)
-      if wide:
-        file = encoder.WidenText(file)
-      if dir:
-        file = dir + os.sep + file
-      if file:
-        self._pathlist.append(file)
-        output.Log('Will attempt to read Sitemap file: %s' % file, 1)
+    self._pathlist.extend(SitemapIndexFiles(self._pathlist[0], urllist))
   #end def _MungeLocationListIntoFiles
 
   def startElement(self, tag, attributes):
@@ -1579,6 +1888,140 @@ class InputSitemap(xml.sax.handler.ContentHandler):
 #end class InputSitemap
 
 
+class InputSitemapStream:
+  """
+  Each Input class knows how to yield a set of URLs from a data source.
+
+  This one reads Sitemap files and Sitemap index files like InputSitemap,
+  for large imports. Files are parsed with cElementTree.iterparse and each
+  url element is handed to the consumer, then discarded, as soon as it
+  closes, so memory use doesn't grow with the size of the file.
+
+  Unlike InputSitemap it doesn't check the schema: elements it doesn't
+  know are skipped.
+  """
+
+  def __init__(self, attributes):
+    self._path          = None              # The first file
+
+    if not ValidateAttributes('SITEMAP', attributes, ('path', 'streaming')):
+      return
+
+    path = attributes.get('path')
+    if path:
+      path = encoder.MaybeNarrowPath(path)
+      if os.path.isfile(path):
+        output.Log('Input: From SITEMAP "%s" (streaming)' % path, 2)
+        self._path = path
+      else:
+        output.Error('Can not locate file "%s"' % path)
+    else:
+      output.Error('Sitemap entries must have a "path" attribute.')
+  #end def __init__
+
+  def ProduceURLs(self, consumer):
+    """ Produces URLs from our data source, hands them in to the consumer. """
+    if not self._path:
+      return
+    locs = self._ProcessFile(self._path, consumer, True)
+    if locs:
+      for path in SitemapIndexFiles(self._path, locs):
+        self._ProcessFile(path, consumer, False)
+  #end def ProduceURLs
+
+  def _ProcessFile(self, path, consumer, allow_index):
+    """
+    Hands the URLs in a Sitemap file to the consumer, or returns the list
+    of Sitemap locations if it's an index.
+    """
+    (frame, file) = OpenFileForRead(path, 'SITEMAP')
+    if not file:
+      return None
+
+    locs = []
+    root = None
+    try:
+      try:
+        for (event, element) in cElementTree.iterparse(file,
+                                                      ('start', 'end')):
+          tag = element.tag[element.tag.rfind('}') + 1:]
+          if root is None:
+            root = element
+            if tag == 'sitemapindex':
+              if not allow_index:
+                output.Error('A Sitemap index can not refer to another '
+                             'Sitemap index.')
+                break
+              output.Log('File is a Sitemap index.', 2)
+            elif tag != 'urlset':
+              output.Error('The document appears to be neither a Sitemap '
+                           'nor a Sitemap index.')
+              break
+            continue
+          if event != 'end':
+            continue
+
+          if tag == 'url':
+            url = URL()
+            for child in element:
+              attribute = child.tag[child.tag.rfind('}') + 1:]
+              if attribute in URL.__slots__ and child.text:
+                url.TrySetAttribute(attribute, child.text.strip())
+            consumer(url, False)
+            root.clear()
+          elif tag == 'sitemap':
+            for child in element:
+              if child.tag[child.tag.rfind('}') + 1:] == 'loc':
+                if child.text and child.text.strip():
+                  locs.append(child.text.strip())
+                break
+            else:
+              output.Warn('In the Sitemap index file, a "sitemap" entry had '
+                          'no "loc".')
+            root.clear()
+      except SyntaxError, e:
+        output.Error('XML error in the file "%s": %s' % (path, e))
+      except IOError:
+        output.Error('Cannot read from file "%s"' % path)
+    finally:
+      file.close()
+      if frame:
+        frame.close()
+    return locs
+  #end def _ProcessFile
+#end class InputSitemapStream
+
+
+def SitemapIndexFiles(index_path, urllist):
+  """
+  Returns the paths of the Sitemap files listed in an index. We assume
+  all the files live in the same directory as the index.  This is not true
+  in general, but will be true for any output produced by this script.
+  """
+  path = os.path.normpath(index_path)
+  dir  = os.path.dirname(path)
+  wide = False
+  if type(path) == types.UnicodeType:
+    wide = True
+
+  files = []
+  for url in urllist:
+    url = URL.Canonicalize(url)
+    output.Log('Index points to Sitemap file at: %s' % url, 2)
+    (scheme, netloc, path, query, frag) = urlparse.urlsplit(url)
+    file = os.path.basename(path)
+    file = urllib.unquote(file)
+    if wide:
+      file = encoder.WidenText(file)
+    if dir:
+      file = dir + os.sep + file
+    if file:
+      files.append(file)
+      output.Log('Will attempt to read Sitemap file: %s' % file, 1)
+  return files
+#end def SitemapIndexFiles
+
+
 class FilePathGenerator:
   """
   This class generates filenames in a series, upon request.
@@ -1723,6 +2166,114 @@ class PerURLStatistics:
         output.Log(' %7d  %s' % (self._extensions[ext], ext), 1)
   #end def Log
 
+  def Extensions(self):
+    """ Returns a copy of the count of each extension """
+    return dict(self._extensions)
+  #end def Extensions
+
+class SitemapWriter:
+  """
+  Compresses and writes Sitemap files, in the calling thread or, if
+  given a number of threads, in the background so that collecting URLs
+  goes on meanwhile (zlib lets other threads run while it compresses).
+  At most two files per thread wait in the queue, to bound memory use.
+
+  Gzipped files have no timestamp in them, and files are only written
+  when their contents change, so unchanged Sitemaps keep their bytes
+  and their modification times.
+
+  The threads work in the RunState of the run that made the writer. If
+  one of them hits an unexpected exception, Close raises it.
+  """
+
+  def __init__(self, is_gzip, level=DEFAULT_COMPRESSION_LEVEL, threads=0):
+    self._is_gzip  = is_gzip
+    self._level    = level
+    self._threads  = []
+    self._failed   = []                     # Paths that couldn't be written
+    self._error    = None                   # sys.exc_info() of a worker
+    self._run      = CurrentRunState()
+    self._queue    = None
+    if threads > 0:
+      self._queue  = Queue.Queue(2 * threads)
+      for i in range(threads):
+        thread = threading.Thread(target=self._Work)
+        thread.setDaemon(True)
+        thread.start()
+        self._threads.append(thread)
+  #end def __init__
+
+  def _Work(self):
+    """ Worker thread: writes queued files until it gets None """
+    self._run.Activate()
+    try:
+      while True:
+        job = self._queue.get()
+        if job is None:
+          return
+        if self._error is not None:
+          continue                          # Keep the queue moving
+        try:
+          self._Write(job[0], job[1])
+        except:
+          self._error = sys.exc_info()
+    finally:
+      self._run.Deactivate()
+  #end def _Work
+
+  def _Write(self, filename, text):
+    """ Compresses text if needed and writes it, if it's not there yet """
+    if self._is_gzip:
+      buffer = cStringIO.StringIO()
+      file = gzip.GzipFile(os.path.basename(filename), 'wb', self._level,
+                           buffer, 0)
+      file.write(text)
+      file.close()
+      text = buffer.getvalue()
+    try:
+      if os.path.isfile(filename):
+        file = open(filename, 'rb')
+        try:
+          if file.read() == text:
+            return
+        finally:
+          file.close()
+      file = open(filename, 'wb')
+      try:
+        file.write(text)
+      finally:
+        file.close()
+      os.chmod(filename, 0644)
+    except (IOError, OSError):
+      self._failed.append(filename)
+  #end def _Write
+
+  def Write(self, filename, text):
+    """ Writes text (the whole Sitemap, uncompressed) to filename """
+    if self._queue is None:
+      self._Write(filename, text)
+    else:
+      self._queue.put((filename, text))
+  #end def Write
+
+  def Close(self):
+    """
+    Waits for the files to be written, and returns the paths of those
+    that couldn't be.
+    """
+    for thread in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error[0], error[1], error[2]
+    return self._failed
+  #end def Close
+#end class SitemapWriter
+
+
 class Sitemap(xml.sax.handler.ContentHandler):
   """
   This is the big workhorse class that processes your inputs and spits
@@ -1733,8 +2284,9 @@ class Sitemap(xml.sax.handler.ContentHandler):
   def __init__(self, suppress_notify):
     xml.sax.handler.ContentHandler.__init__(self)
     self._filters      = []                  # Filter objects
+    self._filter_set   = None                # The filters, compiled
     self._inputs       = []                  # Input objects
-    self._urls         = {}                  # Maps URLs to count of dups
+    self._urls         = URLCounter()        # Maps URLs to count of dups
     self._set          = []                  # Current set of URLs
     self._filegen      = None                # Path generator for output files
     self._wildurl1     = None                # Sitemap URLs to filter out
@@ -1743,6 +2295,8 @@ class Sitemap(xml.sax.handler.ContentHandler):
     # We init _dup_max to 2 so the default priority is 0.5 instead of 1.0
     self._dup_max      = 2                   # Max number of duplicate URLs
     self._stat         = PerURLStatistics()  # Some simple stats
+    self._counts       = {}                  # Count of URLs by fate
+    self._written      = []                  # Paths of the files written
     self._in_site      = False               # SAX: are we in a Site node?
     self._in_Site_ever = False               # SAX: were we ever in a Site?
 
@@ -1750,6 +2304,9 @@ class Sitemap(xml.sax.handler.ContentHandler):
     self._base_url     = None                # Prefix to all valid URLs
     self._store_into   = None                # Output filepath
     self._suppress     = suppress_notify     # Suppress notify of servers
+    self._level        = DEFAULT_COMPRESSION_LEVEL # gzip compression level
+    self._threads      = 0                   # Threads writing files
+    self._writer       = None                # SitemapWriter
   #end def __init__
 
   def ValidateBasicConfig(self):
@@ -1789,6 +2346,24 @@ class Sitemap(xml.sax.handler.ContentHandler):
       self._wildurl2 = self._filegen.GenerateURL(SITEINDEX_SUFFIX,
                                                  self._base_url)
 
+    # Check the output options
+    try:
+      self._level = int(self._level)
+      if (self._level < 1) or (self._level > 9):
+        raise ValueError
+    except ValueError:
+      output.Error('The "compression_level" must be between 1 and 9: %s' %
+                   self._level)
+      all_good = False
+    try:
+      self._threads = int(self._threads)
+      if self._threads < 0:
+        raise ValueError
+    except ValueError:
+      output.Error('The "writer_threads" must be 0 or more: %s' %
+                   self._threads)
+      all_good = False
+
     # Unify various forms of False
     if all_good:
       if self._suppress:
@@ -1805,16 +2380,25 @@ class Sitemap(xml.sax.handler.ContentHandler):
 
   def Generate(self):
     """ Run over all the Inputs and ask them to Produce """
-    # Run the inputs
-    for input in self._inputs:
-      input.ProduceURLs(self.ConsumeURL)
+    self._filter_set = FilterSet(self._filters)
+    self._writer = SitemapWriter(self._filegen.is_gzip, self._level,
+                                 self._threads)
 
-    # Do last flushes
-    if len(self._set):
-      self.FlushSet()
-    if not self._sitemaps:
-      output.Warn('No URLs were recorded, writing an empty sitemap.')
-      self.FlushSet()
+    # Run the inputs
+    try:
+      for input in self._inputs:
+        input.ProduceURLs(self.ConsumeURL)
+
+      # Do last flushes
+      if len(self._set):
+        self.FlushSet()
+      if not self._sitemaps:
+        output.Warn('No URLs were recorded, writing an empty sitemap.')
+        self.FlushSet()
+    finally:
+      failed = self._writer.Close()
+    if failed:
+      output.Fatal('Couldn\'t write out to file: %s' % failed[0])
 
     # Write an index as needed
     if self._sitemaps > 1:
@@ -1827,6 +2411,29 @@ class Sitemap(xml.sax.handler.ContentHandler):
     self._stat.Log()
   #end def Generate
 
+  def Count(self, fate):
+    """ Counts a URL as accepted, duplicate, filtered, ignored or invalid """
+    self._counts[fate] = self._counts.get(fate, 0) + 1
+  #end def Count
+
+  def Statistics(self):
+    """
+    Returns a dictionary describing the run so far: the number of URLs
+    by fate (see Count), the paths of the files written, the count of
+    file extensions on accepted URLs and the numbers of errors and
+    warnings.
+    """
+    stats = {
+      'files':      list(self._written),
+      'extensions': self._stat.Extensions(),
+      'errors':     output.num_errors,
+      'warnings':   output.num_warns,
+      }
+    for fate in ('accepted', 'duplicate', 'filtered', 'ignored', 'invalid'):
+      stats[fate] = self._counts.get(fate, 0)
+    return stats
+  #end def Statistics
+
   def ConsumeURL(self, url, allow_fragment):
     """
     All per-URL processing comes together here, regardless of Input.
@@ -1837,27 +2444,26 @@ class Sitemap(xml.sax.handler.ContentHandler):
 
     # Validate
     if not url.Validate(self._base_url, allow_fragment):
+      self.Count('invalid')
       return
 
     # Run filters
-    accept = None
-    for filter in self._filters:
-      accept = filter.Apply(url)
-      if accept != None:
-        break
+    accept = self._filter_set.Apply(url)
     if not (accept or (accept == None)):
       url.Log(prefix='FILTERED', level=2)
+      self.Count('filtered')
       return
 
     # Ignore our out output URLs
     if fnmatch.fnmatchcase(url.loc, self._wildurl1) or fnmatch.fnmatchcase(
       url.loc, self._wildurl2):
       url.Log(prefix='IGNORED (output file)', level=2)
+      self.Count('ignored')
       return
 
     # Note the sighting
     hash = url.MakeHash()
-    if self._urls.has_key(hash):
+    if hash in self._urls:
       dup = self._urls[hash]
       if dup > 0:
         dup = dup + 1
@@ -1865,10 +2471,12 @@ class Sitemap(xml.sax.handler.ContentHandler):
         if self._dup_max < dup:
           self._dup_max = dup
       url.Log(prefix='DUPLICATE')
+      self.Count('duplicate')
       return
 
     # Acceptance -- add to set
     self._urls[hash] = 1
+    self.Count('accepted')
     self._set.append(url)
     self._stat.Consume(url)
     url.Log()
@@ -1904,32 +2512,14 @@ class Sitemap(xml.sax.handler.ContentHandler):
     output.Log('Writing Sitemap file "%s" with %d URLs' %
         (filename, len(self._set)), 1)
 
-    # Write to it
-    frame = None
-    file  = None
-
-    try:
-      if self._filegen.is_gzip:
-        basename = os.path.basename(filename);
-        frame = open(filename, 'wb')
-        file = gzip.GzipFile(fileobj=frame, filename=basename, mode='wt')
-      else:
-        file = open(filename, 'wt')
-
-      file.write(SITEMAP_HEADER)
-      for url in self._set:
-        url.WriteXML(file)
-      file.write(SITEMAP_FOOTER)
-
-      file.close()
-      if frame:
-        frame.close()
-
-      frame = None
-      file  = None
-    except IOError:
-      output.Fatal('Couldn\'t write out to file: %s' % filename)
-    os.chmod(filename, 0644)
+    # Hand it to the writer
+    file = cStringIO.StringIO()
+    file.write(SITEMAP_HEADER)
+    for url in self._set:
+      url.WriteXML(file)
+    file.write(SITEMAP_FOOTER)
+    self._writer.Write(filename, file.getvalue())
+    self._written.append(filename)
 
     # Flush
     self._set = []
@@ -1944,17 +2534,16 @@ class Sitemap(xml.sax.handler.ContentHandler):
     output.Log('Writing index file "%s" with %d Sitemaps' %
         (filename, self._sitemaps), 1)
 
-    # Make a lastmod time
-    lastmod = TimestampISO8601(time.time())
-
     # Write to it
     try:
       fd = open(filename, 'wt')
       fd.write(SITEINDEX_HEADER)
 
       for mapnumber in range(0,self._sitemaps):
-        # Write the entry
+        # Write the entry, dated when that Sitemap last changed
         mapurl = self._filegen.GenerateURL(mapnumber, self._base_url)
+        mappath = self._filegen.GeneratePath(mapnumber)
+        lastmod = TimestampISO8601(os.stat(mappath).st_mtime)
         mapattributes = { 'loc' : mapurl, 'lastmod' : lastmod }
         fd.write(SITEINDEX_ENTRY % mapattributes)
 
@@ -1965,6 +2554,7 @@ class Sitemap(xml.sax.handler.ContentHandler):
     except IOError:
       output.Fatal('Couldn\'t write out to file: %s' % filename)
     os.chmod(filename, 0644)
+    self._written.append(filename)
   #end def WriteIndex
 
   def NotifySearch(self):
@@ -1975,15 +2565,15 @@ class Sitemap(xml.sax.handler.ContentHandler):
 
     output.Log('Notifying search engines.', 1)
 
-    # Override the urllib's opener class with one that doesn't ignore 404s
+    # Use an opener that doesn't ignore 404s (only here, not for all of
+    # urllib, since other threads may be using it)
     class ExceptionURLopener(urllib.FancyURLopener):
       def http_error_default(self, url, fp, errcode, errmsg, headers):
         output.Log('HTTP error %d: %s' % (errcode, errmsg), 2)
         raise IOError
       #end def http_error_default
     #end class ExceptionURLOpener
-    old_opener = urllib._urlopener
-    urllib._urlopener = ExceptionURLopener()
+    opener = ExceptionURLopener()
 
     # Build the URL we want to send in
     if self._sitemaps > 1:
@@ -1993,7 +2583,7 @@ class Sitemap(xml.sax.handler.ContentHandler):
 
     # Test if we can hit it ourselves
     try:
-      u = urllib.urlopen(url)
+      u = opener.open(url)
       u.close()
     except IOError:
       output.Error('When attempting to access our generated Sitemap at the '
@@ -2006,7 +2596,7 @@ class Sitemap(xml.sax.handler.ContentHandler):
     # Cycle through notifications
     # To understand this, see the comment near the NOTIFICATION_SITES comment
     for ping in NOTIFICATION_SITES:
-      query_map             = ping[3]
+      query_map             = dict(ping[3])
       query_attr            = ping[5]
       query_map[query_attr] = url
       query = urllib.urlencode(query_map)
@@ -2016,14 +2606,11 @@ class Sitemap(xml.sax.handler.ContentHandler):
       output.Log('Notifying: %s' % ping[1], 1)
       output.Log('Notification URL: %s' % notify, 2)
       try:
-        u = urllib.urlopen(notify)
+        u = opener.open(notify)
         u.read()
         u.close()
       except IOError:
         output.Warn('Cannot contact: %s' % ping[1])
-
-    if old_opener:
-      urllib._urlopener = old_opener
   #end def NotifySearch
 
   def startElement(self, tag, attributes):
@@ -2037,7 +2624,8 @@ class Sitemap(xml.sax.handler.ContentHandler):
 
         if not ValidateAttributes('SITE', attributes,
           ('verbose', 'default_encoding', 'base_url', 'store_into',
-           'suppress_search_engine_notify')):
+           'suppress_search_engine_notify', 'compression_level',
+           'writer_threads')):
           return
 
         verbose           = attributes.get('verbose', 0)
@@ -2047,6 +2635,8 @@ class Sitemap(xml.sax.handler.ContentHandler):
         self._default_enc = attributes.get('default_encoding')
         self._base_url    = attributes.get('base_url')
         self._store_into  = attributes.get('store_into')
+        self._level       = attributes.get('compression_level', self._level)
+        self._threads     = attributes.get('writer_threads', self._threads)
         if not self._suppress:
           self._suppress  = attributes.get('suppress_search_engine_notify',
                                             False)
@@ -2066,12 +2656,16 @@ class Sitemap(xml.sax.handler.ContentHandler):
       self._inputs.append(InputDirectory(attributes, self._base_url))
 
     elif tag == 'accesslog':
-      for attributeset in ExpandPathAttribute(attributes, 'path'):
-        self._inputs.append(InputAccessLog(attributeset))
+      # Expands the path itself, to count hits over all the files
+      self._inputs.append(InputAccessLog(attributes))
 
     elif tag == 'sitemap':
       for attributeset in ExpandPathAttribute(attributes, 'path'):
-        self._inputs.append(InputSitemap(attributeset))
+        streaming = attributeset.get('streaming', 'false')
+        if streaming.lower() not in ('0', 'false'):
+          self._inputs.append(InputSitemapStream(attributeset))
+        else:
+          self._inputs.append(InputSitemap(attributeset))
 
     else:
       output.Error('Unrecognized tag in the configuration: %s' % tag)
@@ -2164,6 +2758,43 @@ def OpenFileForRead(path, logtext):
   return (frame, file)
 #end def OpenFileForRead
 
+def WildcardToRegexp(pattern):
+  """
+  Translates a wildcard into a regular expression, like fnmatch.translate
+  but without flags, so that it can be combined with other expressions.
+  """
+  i, n = 0, len(pattern)
+  result = []
+  while i < n:
+    c = pattern[i]
+    i = i + 1
+    if c == '*':
+      result.append(r'[\s\S]*')
+    elif c == '?':
+      result.append(r'[\s\S]')
+    elif c == '[':
+      j = i
+      if j < n and pattern[j] == '!':
+        j = j + 1
+      if j < n and pattern[j] == ']':
+        j = j + 1
+      while j < n and pattern[j] != ']':
+        j = j + 1
+      if j >= n:
+        result.append('\\[')
+      else:
+        stuff = pattern[i:j].replace('\\', '\\\\')
+        i = j + 1
+        if stuff[0] == '!':
+          stuff = '^' + stuff[1:]
+        elif stuff[0] == '^':
+          stuff = '\\' + stuff
+        result.append('[%s]' % stuff)
+    else:
+      result.append(re.escape(c))
+  return ''.join(result)
+#end def WildcardToRegexp
+
 def TimestampISO8601(t):
   """Seconds since epoch (1970-01-01) --> ISO 8601 time string."""
   return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
@@ -2196,6 +2827,30 @@ def CreateSitemapFromFile(configpath, suppress_notify):
   return None
 #end def CreateSitemapFromFile
 
+def GenerateSitemap(configpath, suppress_notify=True, verbose=None):
+  """
+  Generates the sitemap described by a configuration file, with a state
+  of its own (see RunState), and returns its statistics (see
+  Sitemap.Statistics) or None if the configuration has errors. Messages
+  are still printed, how many depends on verbose, if given, or on the
+  configuration.
+
+  Raises FatalError if writing the sitemap fails.
+  """
+  state = RunState()
+  state.Activate()
+  try:
+    if verbose is not None:
+      output.SetVerbose(verbose)
+    sitemap = CreateSitemapFromFile(configpath, suppress_notify)
+    if not sitemap:
+      return None
+    sitemap.Generate()
+    return sitemap.Statistics()
+  finally:
+    state.Deactivate()
+#end def GenerateSitemap
+
 def ProcessCommandFlags(args):
   """
   Parse command line flags per specified usage, pick off key, value pairs
@@ -2235,6 +2890,9 @@ if __name__ == '__main__':
     if not sitemap:
       output.Log('Configuration file errors -- exiting.', 0)
     else:
-      sitemap.Generate()
+      try:
+        sitemap.Generate()
+      except FatalError:
+        sys.exit(1)
       output.Log('Number of errors: %d' % output.num_errors, 1)
       output.Log('Number of warnings: %d' % output.num_warns, 1)
@@ -0,0 +1,217 @@
+"""Sitemaps built from the pages Nikola renders.
+
+The renderers record each page they write, with its last modification
+date, so the sitemap can be written without walking the output folder.
+
+URLs are split in shards by section (the first folder in their path),
+and big sections are split further by a hash of the URL, so a shard's
+contents only change when pages in it do. A sitemap index points to
+every shard.
+
+The lastmod of a page can be its date (the post's date, or the newest
+post in a list), or the last time its contents changed, as recorded by
+a LastChangedStore.
+"""
+
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import zlib
+from xml.sax.saxutils import escape
+
+__all__ = ['page_url', 'w3c_date', 'shard_entries', 'write_sitemap',
+    'write_sitemap_index', 'LastChangedStore', 'write_content_sitemap',
+    'write_content_sitemap_index']
+
+# The protocol allows 50000, leave room for sections to grow
+MAX_SHARD_URLS = 40000
+
+
+def page_url(blog_url, output_folder, output_name):
+    """Return the URL of the file output_name in output_folder."""
+    rel_path = os.path.relpath(output_name, output_folder)
+    return blog_url.rstrip('/') + '/' + rel_path.replace(os.sep, '/')
+
+
+def w3c_date(date):
+    """Format a datetime (or None) for a sitemap's lastmod."""
+    if date is None:
+        return None
+    return date.strftime('%Y-%m-%d')
+
+
+def write_sitemap(entries, output_path):
+    """Write a gzipped sitemap.
+
+    entries is a list of (URL, lastmod), where lastmod is a W3C date
+    string or None.
+    """
+    dst_dir = os.path.dirname(output_path)
+    if dst_dir and not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    with open(output_path, 'wb') as raw_file:
+        # mtime=0 so the same entries make the same file
+        out_file = gzip.GzipFile(os.path.basename(output_path), 'wb', 9,
+            raw_file, 0)
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for url, lastmod in entries:
+            out_file.write(' <url>\n  <loc>%s</loc>\n' %
+                escape(url).encode('utf8'))
+            if lastmod:
+                out_file.write('  <lastmod>%s</lastmod>\n' % lastmod)
+            out_file.write(' </url>\n')
+        out_file.write('</urlset>\n')
+        out_file.close()
+
+
+def _section(url, blog_url):
+    path = url[len(blog_url.rstrip('/')) + 1:]
+    if '/' not in path:
+        return 'root'
+    return re.sub(r'[^-\w]', '_', path.split('/', 1)[0])
+
+
+def shard_entries(entries, blog_url, max_urls=MAX_SHARD_URLS):
+    """Split (URL, lastmod) entries in shards.
+
+    The second element of entries can be anything, it's kept as is.
+
+    Returns a dictionary of shard name to sorted entries. Shards are
+    named after sections; sections with more than max_urls URLs become
+    "section-0", "section-1", ... by a hash of the URL.
+    """
+    sections = {}
+    for url, lastmod in entries:
+        sections.setdefault(_section(url, blog_url), []).append(
+            (url, lastmod))
+    shards = {}
+    for section, section_entries in sections.items():
+        if len(section_entries) <= max_urls:
+            shards[section] = sorted(section_entries)
+            continue
+        buckets = int(math.ceil(len(section_entries) / float(max_urls)))
+        for url, lastmod in section_entries:
+            name = '%s-%d' % (section,
+                (zlib.crc32(url.encode('utf8')) & 0xffffffff) % buckets)
+            shards.setdefault(name, []).append((url, lastmod))
+        for name in shards:
+            shards[name].sort()
+    return shards
+
+
+def write_sitemap_index(shards, output_path, stale_pattern=None):
+    """Write a gzipped sitemap index.
+
+    shards is a list of (URL, lastmod) of the shard files. If given,
+    files matching the glob stale_pattern that are not in shards are
+    deleted, so removed sections don't linger.
+    """
+    dst_dir = os.path.dirname(output_path)
+    if dst_dir and not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    with open(output_path, 'wb') as raw_file:
+        out_file = gzip.GzipFile(os.path.basename(output_path), 'wb', 9,
+            raw_file, 0)
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sitemapindex '
+            'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for url, lastmod in shards:
+            out_file.write(' <sitemap>\n  <loc>%s</loc>\n' %
+                escape(url).encode('utf8'))
+            if lastmod:
+                out_file.write('  <lastmod>%s</lastmod>\n' % lastmod)
+            out_file.write(' </sitemap>\n')
+        out_file.write('</sitemapindex>\n')
+        out_file.close()
+    if stale_pattern:
+        current = set(os.path.basename(url) for url, _ in shards)
+        for path in glob.glob(stale_pattern):
+            if os.path.basename(path) not in current:
+                os.unlink(path)
+
+
+class LastChangedStore(object):
+    """When the contents of each file last changed.
+
+    Stored as JSON in path, by file: mtime, size, MD5 of the contents
+    and the date they last changed. Files whose mtime and size didn't
+    change are not read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, 'rb') as store_file:
+                try:
+                    self.entries = json.load(store_file)
+                except ValueError:
+                    # Unreadable, so files count as changed when they
+                    # were last modified
+                    pass
+
+    def lastmod(self, file_path):
+        """Return the W3C date when file_path's contents last changed."""
+        stat = os.stat(file_path)
+        entry = self.entries.get(file_path)
+        if entry and entry[:2] == [stat.st_mtime, stat.st_size]:
+            return entry[3]
+        digest = hashlib.md5()
+        with open(file_path, 'rb') as in_file:
+            digest.update(in_file.read())
+        digest = digest.hexdigest()
+        if entry and entry[2] == digest:
+            # Written again, but with the same contents
+            lastmod = entry[3]
+        else:
+            lastmod = w3c_date(
+                datetime.datetime.utcfromtimestamp(stat.st_mtime))
+        self.entries[file_path] = [stat.st_mtime, stat.st_size, digest,
+            lastmod]
+        return lastmod
+
+    def newest(self):
+        """Return the newest lastmod in the store, or None."""
+        return max([entry[3] for entry in self.entries.values()] or [None])
+
+    def save(self, keep):
+        """Save the entries for the files in keep, forget the rest."""
+        keep = set(keep)
+        self.entries = dict((path, entry)
+            for path, entry in self.entries.items() if path in keep)
+        store_dir = os.path.dirname(self.path)
+        if store_dir and not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        # Never leave a truncated file behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as store_file:
+            json.dump(self.entries, store_file)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+
+
+def write_content_sitemap(pages, output_path, store_path):
+    """Write a sitemap with lastmods from a LastChangedStore.
+
+    pages is a list of (URL, path of the rendered file).
+    """
+    store = LastChangedStore(store_path)
+    entries = [(url, store.lastmod(path)) for url, path in pages]
+    store.save(path for _, path in pages)
+    write_sitemap(entries, output_path)
+
+
+def write_content_sitemap_index(shards, output_path, stale_pattern=None):
+    """Write a sitemap index for shards written by write_content_sitemap.
+
+    shards is a list of (URL, store path).
+    """
+    write_sitemap_index([(url, LastChangedStore(store_path).newest())
+        for url, store_path in shards], output_path, stale_pattern)
@@ -1,21 +1,23 @@
 """Utility functions."""
 
 from collections import defaultdict
-import datetime
 import os
 import re
 import codecs
+import gzip
 import shutil
 import sys
 from zipfile import ZipFile as zip
 
 from unidecode import unidecode
 
-import PyRSS2Gen as rss
+import feeds
 
 __all__ = ['get_theme_path', 'get_theme_chain', 'load_messages', 'copy_tree',
     'get_compile_html', 'get_template_module', 'generic_rss_renderer',
-    'copy_file', 'slugify']
+    'copy_file', 'copy_summary', 'gzip_file', 'remove_file', 'slugify']
+
+COPY_STRATEGIES = ('copy', 'hardlink', 'reflink')
 
 def get_theme_path(theme):
     """Given a theme name, returns the path where its files are located.
@@ -120,9 +122,11 @@ def load_messages(themes, translations):
     return messages
 
 
-def copy_tree(src, dst):
+def copy_tree(src, dst, copy_strategy='copy'):
     """Copy a src tree to the dst folder.
 
+    copy_strategy is passed to copy_file.
+
     Example:
 
     src = "themes/default/assets"
@@ -147,7 +151,8 @@ def copy_tree(src, dst):
                 'name': dst_file,
                 'file_dep': [src_file],
                 'targets': [dst_file],
-                'actions': [(copy_file, (src_file, dst_file))],
+                'actions': [(copy_file,
+                    (src_file, dst_file, copy_strategy))],
                 'clean': True,
             }
 
@@ -229,36 +234,98 @@ def get_template_module(template_engine, themes):
 def generic_rss_renderer(lang, title, link, description,
     timeline, output_path):
     """Takes all necessary data, and renders a RSS feed in output_path."""
-    items = []
-    for post in timeline[:10]:
-        args = {
-            'title': post.title(lang),
-            'link': post.permalink(lang),
-            'description': post.text(lang),
-            'guid': post.permalink(lang),
-            'pubDate': post.date,
-        }
-        items.append(rss.RSSItem(**args))
-    rss_obj = rss.RSS2(
-        title=title,
-        link=link,
-        description=description,
-        lastBuildDate=datetime.datetime.now(),
-        items=items,
-        generator='nikola',
-    )
-    dst_dir = os.path.dirname(output_path)
-    if not os.path.isdir(dst_dir):
-        os.makedirs(dst_dir)
-    with open(output_path, "wb+") as rss_file:
-        rss_obj.write_xml(rss_file)
+    feeds.render_rss(feeds.FeedItemCache(), lang, title, link, description,
+        timeline[:10], output_path)
+
 
+def copy_file(source, dest, strategy='copy'):
+    """Copy source to dest.
 
-def copy_file(source, dest):
+    strategy is one of COPY_STRATEGIES:
+
+    * "copy" makes a regular copy.
+    * "hardlink" makes dest another name for source, so they share
+      disk space (and changing one changes the other).
+    * "reflink" makes a copy-on-write clone, on filesystems that
+      support it (like btrfs or XFS).
+
+    If a link can't be made (for example, across filesystems), the
+    file is copied.
+    """
+    if strategy not in COPY_STRATEGIES:
+        raise ValueError('Unknown copy strategy: %r' % strategy)
     dst_dir = os.path.dirname(dest)
     if not os.path.isdir(dst_dir):
         os.makedirs(dst_dir)
-    shutil.copy2(source, dest)
+    # Never write through an old link into its source
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    method = 'copy'
+    if strategy == 'hardlink':
+        try:
+            os.link(source, dest)
+            method = 'hardlink'
+        except (AttributeError, OSError):
+            pass
+    elif strategy == 'reflink' and _reflink(source, dest):
+        method = 'reflink'
+    if method == 'copy':
+        shutil.copy2(source, dest)
+
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def _reflink(source, dest):
+    """Clone source into dest, return False if it's not supported."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    cloned = True
+    with open(source, 'rb') as src_file:
+        with open(dest, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except (IOError, OSError):
+                cloned = False
+    if not cloned:
+        os.unlink(dest)
+        return False
+    shutil.copystat(source, dest)
+    return True
+
+
+def copy_summary(strategy):
+    """Print the strategy used to copy files into the output."""
+    print 'Files copied using COPY_STRATEGY = %r' % (strategy,)
+
+
+def gzip_file(source, dest, min_size=0):
+    """Write a copy of source compressed at the maximum level to dest.
+
+    Files smaller than min_size are not worth it, so they get no
+    compressed copy. The copy gets the mtime of the source.
+    """
+    stat = os.stat(source)
+    if stat.st_size < min_size:
+        remove_file(dest)
+        return
+    with open(source, 'rb') as in_file:
+        data = in_file.read()
+    # mtime=0 keeps the output identical if the source didn't change
+    with open(dest, 'wb') as out_file:
+        gz_file = gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+            fileobj=out_file, mtime=0)
+        gz_file.write(data)
+        gz_file.close()
+    os.utime(dest, (stat.st_atime, stat.st_mtime))
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.unlink(path)
 
 
 # slugify is copied from